@@ -0,0 +1,401 @@
+"""OTA server benchmarks."""
+
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from urllib.parse import urlencode
+
+import aiocoap
+import aiocoap.resource as resource
+from aiocoap import Context, Message, GET, CHANGED, CONTENT
+from aiocoap.optiontypes import BlockOption
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_PATH = os.path.join(ROOT_PATH, 'otaserver')
+sys.path.insert(0, SERVER_PATH)
+
+from cache import FirmwareCache  # noqa: E402
+from catalog import FirmwareCatalog  # noqa: E402
+from coap import FileResource  # noqa: E402
+from blocks import BlockPolicy  # noqa: E402
+from metrics import CoapMetrics  # noqa: E402
+
+
+LOGGER = logging.getLogger("otabenchmark")
+LOGGER.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)-15s %(levelname)-7s '
+                              '%(filename)10s:%(lineno)-3d %(message)s')
+console_handler = logging.StreamHandler(sys.stderr)
+console_handler.setFormatter(formatter)
+LOGGER.addHandler(console_handler)
+
+BENCHMARKS = ('blocks', 'catalog', 'publish', 'notify')
+CHUNK_SIZE = 64 * 1024
+
+
+def _sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="OTA server benchmarks")
+    parser.add_argument('--only', type=str, default=','.join(BENCHMARKS),
+                        help="Comma separated list of benchmarks to run "
+                             "among {}.".format(', '.join(BENCHMARKS)))
+    parser.add_argument('--block-file-size', type=int, default=1024 * 1024,
+                        help="Size in bytes of the file served blockwise.")
+    parser.add_argument('--block-szx', type=_sizes, default='0,2,4,6',
+                        help="Block size exponents (block size is "
+                             "2 ** (szx + 4)).")
+    parser.add_argument('--catalog-versions', type=_sizes,
+                        default='10,1000,10000',
+                        help="Number of versions of the synthetic catalogs.")
+    parser.add_argument('--publish-sizes', type=_sizes,
+                        default='1048576,16777216,67108864',
+                        help="Size in bytes of the published slot images.")
+    parser.add_argument('--notify-nodes', type=_sizes, default='10,100,500',
+                        help="Number of local nodes notified.")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of runs of each measurement, the best "
+                             "one is kept.")
+    parser.add_argument('--output', type=str, default=None,
+                        help="Write the JSON results to this file.")
+    parser.add_argument('--compare', type=str, default=None,
+                        help="JSON results of a previous run to compare "
+                             "with.")
+    return parser.parse_args()
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _free_port(family=socket.AF_INET, kind=socket.SOCK_STREAM):
+    with socket.socket(family, kind) as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+
+def _publish_tree(upload_path, publish_id, versions):
+    store_path = os.path.join(upload_path, publish_id)
+    os.makedirs(store_path)
+    # Files named as published by RIOT, with the latest manifest aliases
+    names = ['slot0.riot.suit.latest.bin', 'slot1.riot.suit.latest.bin']
+    for version in range(versions):
+        names += [name.format(version) for name in (
+            'slot0.riot.suit.{}.bin', 'slot1.riot.suit.{}.bin',
+            'slot0.{}.bin', 'slot1.{}.bin')]
+    for name in names:
+        with open(os.path.join(store_path, 'app-' + name), 'wb') as f:
+            f.write(b'\0' * 16)
+
+
+class _Controller():
+    """Stand-in of the CoAP server used by the served FileResource."""
+
+    def __init__(self, upload_path, catalog):
+        self.upload_path = upload_path
+        self.catalog = catalog
+        self.cache = FirmwareCache()
+        self.metrics = CoapMetrics()
+        self.block_policy = BlockPolicy()
+
+    def record_fetch(self, remote, publish_id):
+        pass
+
+    def transfer_done(self, remote, publish_id, filename):
+        pass
+
+
+async def bench_blocks(args, tmp_path):
+    """Serve a file blockwise with FileResource.render_get."""
+    upload_path = os.path.join(tmp_path, 'blocks')
+    os.makedirs(os.path.join(upload_path, 'board_app'))
+    filename = 'app-slot0.1.bin'
+    with open(os.path.join(upload_path, 'board_app', filename), 'wb') as f:
+        f.write(os.urandom(args.block_file_size))
+    catalog = FirmwareCatalog(upload_path)
+    catalog.build()
+    file_resource = FileResource(_Controller(upload_path, catalog),
+                                 'board_app', filename)
+
+    results = []
+    for szx in args.block_szx:
+        block_size = 2 ** (szx + 4)
+        best = None
+        for _ in range(args.repeat):
+            latencies = []
+            block_number = 0
+            start = time.perf_counter()
+            while True:
+                request = Message(code=GET, block2=BlockOption.BlockwiseTuple(
+                    block_number, 0, szx))
+                request.remote = ('::1', 5683)
+                block_start = time.perf_counter()
+                response = await file_resource.render_get(request)
+                latencies.append(time.perf_counter() - block_start)
+                if not response.opt.block2.more:
+                    break
+                block_number += 1
+            duration = time.perf_counter() - start
+            if best is None or duration < best[0]:
+                best = (duration, latencies)
+        duration, latencies = best
+        results.append({
+            'block_size': block_size,
+            'blocks': len(latencies),
+            'seconds': duration,
+            'blocks_per_second': len(latencies) / duration,
+            'bytes_per_second': args.block_file_size / duration,
+            'latency_p50': _percentile(latencies, 50),
+            'latency_p99': _percentile(latencies, 99),
+        })
+        LOGGER.info('blocks: %d bytes blocks, %.0f blocks/s', block_size,
+                    results[-1]['blocks_per_second'])
+    return results
+
+
+async def bench_catalog(args, tmp_path):
+    """Build the catalog of synthetic upload trees."""
+    results = []
+    for versions in args.catalog_versions:
+        upload_path = os.path.join(tmp_path, 'catalog-{}'.format(versions))
+        _publish_tree(upload_path, 'board_app', versions)
+        build, applications = None, None
+        for _ in range(args.repeat):
+            catalog = FirmwareCatalog(upload_path)
+            start = time.perf_counter()
+            catalog.build()
+            duration = time.perf_counter() - start
+            build = duration if build is None else min(build, duration)
+            start = time.perf_counter()
+            catalog.applications()
+            duration = time.perf_counter() - start
+            applications = duration if applications is None \
+                else min(applications, duration)
+        results.append({'versions': versions,
+                        'files': catalog.stats()['files'],
+                        'build_seconds': build,
+                        'applications_seconds': applications})
+        LOGGER.info('catalog: %d versions, build %.3fs', versions, build)
+    return results
+
+
+class _Server():
+    """OTA server started in a subprocess."""
+
+    def __init__(self, tmp_path):
+        self.upload_path = tempfile.mkdtemp(dir=tmp_path)
+        self.http_port = _free_port()
+        self.coap_port = _free_port(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.url = 'http://localhost:{}'.format(self.http_port)
+        self.process = None
+
+    async def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(SERVER_PATH, 'main.py'),
+             '--upload-path={}'.format(self.upload_path),
+             '--http_port={}'.format(self.http_port),
+             '--coap_port={}'.format(self.coap_port),
+             '--coap_host=[::1]', '--logging=none'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        client = AsyncHTTPClient()
+        for _ in range(100):
+            try:
+                await client.fetch('{}/catalog'.format(self.url))
+            except Exception:
+                await asyncio.sleep(0.1)
+            else:
+                return
+        raise RuntimeError('OTA server did not start')
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def _multipart_producer(boundary, fields, files):
+    async def _produce(write):
+        for name, value in fields.items():
+            await write('--{}\r\nContent-Disposition: form-data; '
+                        'name="{}"\r\n\r\n{}\r\n'.format(
+                            boundary, name, value).encode())
+        for name, size in files.items():
+            await write('--{}\r\nContent-Disposition: form-data; '
+                        'name="{}"; filename="{}"\r\nContent-Type: '
+                        'application/octet-stream\r\n\r\n'.format(
+                            boundary, name, name).encode())
+            chunk = os.urandom(CHUNK_SIZE)
+            for offset in range(0, size, CHUNK_SIZE):
+                await write(chunk[:size - offset])
+            await write(b'\r\n')
+        await write('--{}--\r\n'.format(boundary).encode())
+    return _produce
+
+
+async def bench_publish(args, tmp_path):
+    """Publish updates with large multipart bodies."""
+    server = _Server(tmp_path)
+    await server.start()
+    client = AsyncHTTPClient()
+    boundary = 'otabenchmark{}'.format(os.urandom(8).hex())
+    results = []
+    try:
+        version = 0
+        for size in args.publish_sizes:
+            best = None
+            for _ in range(args.repeat):
+                version += 1
+                files = {'app-slot0.riot.suit.{}.bin'.format(version): 512,
+                         'app-slot0.{}.bin'.format(version): size}
+                request = HTTPRequest(
+                    '{}/publish'.format(server.url), method='POST',
+                    headers={'Content-Type': 'multipart/form-data; '
+                             'boundary={}'.format(boundary)},
+                    body_producer=_multipart_producer(
+                        boundary, {'publish_id': 'board_app'}, files),
+                    request_timeout=600)
+                start = time.perf_counter()
+                await client.fetch(request)
+                duration = time.perf_counter() - start
+                best = duration if best is None else min(best, duration)
+            results.append({'size': size, 'seconds': best,
+                            'bytes_per_second': size / best})
+            LOGGER.info('publish: %d bytes, %.3fs', size, best)
+    finally:
+        server.stop()
+    return results
+
+
+class _TriggerResource(resource.Resource):
+
+    async def render_post(self, request):
+        return aiocoap.Message(code=CHANGED, payload=request.payload)
+
+
+class _InactiveResource(resource.Resource):
+
+    async def render_get(self, request):
+        return aiocoap.Message(code=CONTENT, payload=b'0')
+
+
+async def bench_notify(args, tmp_path):
+    """Notify local stand-in nodes that acknowledge the trigger.
+
+    The measure includes the queueing of the notification job.
+    """
+    server = _Server(tmp_path)
+    await server.start()
+    client = AsyncHTTPClient()
+    await client.fetch(HTTPRequest(
+        '{}/publish'.format(server.url), method='POST',
+        headers={'Content-Type': 'multipart/form-data; boundary=otabench'},
+        body_producer=_multipart_producer(
+            'otabench', {'publish_id': 'board_app'},
+            {'app-slot0.riot.suit.1.bin': 512,
+             'app-slot1.riot.suit.1.bin': 512})))
+    site = resource.Site()
+    site.add_resource(('suit', 'trigger', ), _TriggerResource())
+    site.add_resource(('suit', 'slot', 'inactive', ), _InactiveResource())
+
+    results = []
+    try:
+        for count in args.notify_nodes:
+            nodes = []
+            for _ in range(count):
+                port = _free_port(socket.AF_INET6, socket.SOCK_DGRAM)
+                nodes.append((port, await Context.create_server_context(
+                    site, bind=('::1', port))))
+            body = urlencode({'publish_id': 'board_app',
+                              'urls': ','.join('[::1]:{}'.format(port)
+                                               for port, _ in nodes)})
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                response = await client.fetch(
+                    '{}/notify'.format(server.url), method='POST', body=body,
+                    request_timeout=600)
+                # Wait for the end of the notification job
+                job_url = '{}/jobs/{}'.format(
+                    server.url, json.loads(response.body)['job'])
+                while True:
+                    progress = json.loads((await client.fetch(job_url)).body)
+                    if progress['finished'] is not None:
+                        break
+                    await asyncio.sleep(0.01)
+                duration = time.perf_counter() - start
+                best = duration if best is None else min(best, duration)
+            notified = progress['states'].get('notified', 0)
+            for _, context in nodes:
+                await context.shutdown()
+            results.append({'nodes': count, 'notified': notified,
+                            'seconds': best,
+                            'devices_per_second': count / best})
+            LOGGER.info('notify: %d nodes, %.3fs', count, best)
+    finally:
+        server.stop()
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT_PATH,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(results, previous):
+    """Print the ratio of the measures of two runs."""
+    for name, runs in results['benchmarks'].items():
+        for run, base in zip(runs, previous['benchmarks'].get(name, [])):
+            for key, value in run.items():
+                if not isinstance(value, float) or not base.get(key):
+                    continue
+                print('{:8} {:50} {:8.3f}x'.format(
+                    name, '{} {}'.format(
+                        ' '.join('{}={}'.format(k, v) for k, v in run.items()
+                                 if isinstance(v, int)), key),
+                    value / base[key]))
+
+
+async def run(args):
+    benchmarks = {'blocks': bench_blocks, 'catalog': bench_catalog,
+                  'publish': bench_publish, 'notify': bench_notify}
+    results = {'commit': _commit(),
+               'python': platform.python_version(),
+               'aiocoap': aiocoap.meta.version,
+               'date': time.time(),
+               'benchmarks': {}}
+    with tempfile.TemporaryDirectory() as tmp_path:
+        for name in args.only.split(','):
+            results['benchmarks'][name] = await benchmarks[name](
+                args, tmp_path)
+    return results
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            _compare(results, json.load(f))
+    else:
+        print(output)
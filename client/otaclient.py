@@ -1,7 +1,13 @@
+import os
+import json
+import uuid
 import argparse
 import requests
 
 
+CHUNK_SIZE = 64 * 1024
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="OTA publisher")
     parser.add_argument('--ota-host-url', type=str,
@@ -11,6 +17,11 @@ def parse_args():
                         help="published version identifier, should be unique")
     parser.add_argument('--files', nargs='+',
                         help="list of files to publish")
+    parser.add_argument('--batch', nargs='+', action='append',
+                        metavar=('PUBLISH_ID', 'FILE'),
+                        help="publish identifier followed by its files, "
+                             "repeat to publish several applications in a "
+                             "single request")
     parser.add_argument('--notify', nargs='+',
                         help="list of device urls to use to notify an update")
     parser.add_argument('--notifyv4', nargs='+',
@@ -19,14 +30,75 @@ def parse_args():
     return parser.parse_args()
 
 
+class MultipartStream():
+    """multipart/form-data body streaming the files from disk.
+
+    The length of the body is known in advance, so it is sent with a
+    Content-Length header rather than in chunks.
+    """
+
+    def __init__(self, fields, files):
+        self.boundary = uuid.uuid4().hex
+        self._segments = []
+        for name, value in fields.items():
+            self._segments.append(
+                '--{}\r\nContent-Disposition: form-data; name="{}"'
+                '\r\n\r\n{}\r\n'.format(self.boundary, name, value).encode())
+        for name, path in files:
+            self._segments.append(
+                '--{}\r\nContent-Disposition: form-data; name="{}"; '
+                'filename="{}"\r\nContent-Type: application/octet-stream'
+                '\r\n\r\n'.format(self.boundary, name,
+                                    os.path.basename(path)).encode())
+            self._segments.append(path)
+            self._segments.append(b'\r\n')
+        self._segments.append('--{}--\r\n'.format(self.boundary).encode())
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        return sum(len(segment) if isinstance(segment, bytes)
+                   else os.path.getsize(segment)
+                   for segment in self._segments)
+
+    def __iter__(self):
+        for segment in self._segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            with open(segment, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    yield chunk
+
+
+def _post_stream(url, body):
+    return requests.post(url, data=body,
+                         headers={'Content-Type': body.content_type})
+
+
 def publish_files(args):
-    files_dict = dict()
-    for file in args.files:
-        files_dict[file] = open(file, 'rb').read()
-    response = requests.post('{}/publish'.format(args.ota_host_url),
-                             files=files_dict,
-                             data=dict(publish_id=args.publish_id))
+    body = MultipartStream(dict(publish_id=args.publish_id),
+                           [(file, file) for file in args.files])
+    response = _post_stream('{}/publish'.format(args.ota_host_url), body)
+    print('{}: {}'.format(response.status_code, response.reason))
+
+
+def publish_batch(args):
+    files = []
+    for publish_id, *batch_files in args.batch:
+        files += [(publish_id, file) for file in batch_files]
+    fields = {}
+    if args.notify is not None and len(args.notify) > 0:
+        # Notify the devices of the update of each application
+        fields['notify'] = json.dumps(
+            {publish_id: args.notify for publish_id, *_ in args.batch})
+    body = MultipartStream(fields, files)
+    response = _post_stream('{}/publishbatch'.format(args.ota_host_url), body)
     print('{}: {}'.format(response.status_code, response.reason))
+    if response.status_code == 200:
+        print(json.dumps(response.json(), indent=2))
 
 
 def notify(args):
@@ -44,6 +116,9 @@ def notifyv4(args):
 
 
 def main(args):
+    if args.batch is not None:
+        publish_batch(args)
+        return
     if args.files is not None and len(args.files) > 0:
         publish_files(args)
     if args.notify is not None and len(args.notify) > 0:
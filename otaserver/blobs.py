@@ -0,0 +1,133 @@
+"""Content-addressed firmware storage module."""
+
+import os
+import uuid
+import logging
+import threading
+
+logger = logging.getLogger("otaserver")
+
+
+BLOBS_DIR = '.blobs'
+
+
+class BlobStore():
+    """Deduplicated storage of the published files.
+
+    The content of each file is stored once, in a blob named after its
+    SHA-256 digest, and the version files and `latest` aliases of the
+    applications are hard links to the blobs. The number of references to a
+    blob is its link count minus one: a blob is removed when it's no longer
+    linked from any application. If the filesystem doesn't support hard
+    links, files are copied and nothing is deduplicated.
+
+    Methods of this class are blocking and meant to be run by the storage
+    workers, a lock serializes the updates of the link counts.
+    """
+
+    def __init__(self, upload_path):
+        self.path = os.path.join(upload_path, BLOBS_DIR)
+        self.stored = 0
+        self.deduplicated = 0
+        self.deduplicated_bytes = 0
+        self.released = 0
+        self._lock = threading.Lock()
+
+    def blob_path(self, sha256):
+        """Return the path of the blob of a digest."""
+        return os.path.join(self.path, sha256)
+
+    def _link(self, blob_path, path, tmp_dir):
+        # Create the link under a temporary name and atomically move it in place
+        _tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        try:
+            os.link(blob_path, _tmp_path)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            with open(blob_path, 'rb') as src, open(_tmp_path, 'wb') as dst:
+                dst.write(src.read())
+            os.chmod(_tmp_path, 0o644)
+        os.replace(_tmp_path, path)
+
+    def _release(self, sha256):
+        # Remove the blob if it's only referenced by its own name
+        _blob_path = self.blob_path(sha256)
+        try:
+            if os.stat(_blob_path).st_nlink > 1:
+                return False
+            os.remove(_blob_path)
+        except FileNotFoundError:
+            return False
+        logger.debug('Released blob %s', sha256)
+        self.released += 1
+        return True
+
+    def store(self, tmp_path, sha256, path, tmp_dir, previous=None):
+        """Store the content of a temporary file at path.
+
+        The temporary file becomes the blob of its digest, or is dropped if
+        the blob already exists. `previous` is the digest of the file
+        replaced at path, if any, whose blob is released.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        _blob_path = self.blob_path(sha256)
+        with self._lock:
+            if os.path.exists(_blob_path):
+                logger.debug('Blob %s already stored', sha256)
+                self.deduplicated += 1
+                self.deduplicated_bytes += os.path.getsize(tmp_path)
+                os.remove(tmp_path)
+            else:
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, _blob_path)
+                self.stored += 1
+            self._link(_blob_path, path, tmp_dir)
+            if previous is not None and previous != sha256:
+                self._release(previous)
+
+    def link(self, sha256, path, tmp_dir, previous=None):
+        """Make path a reference to the blob of a digest.
+
+        `previous` is the digest of the file replaced at path, if any, whose
+        blob is released.
+        """
+        with self._lock:
+            self._link(self.blob_path(sha256), path, tmp_dir)
+            if previous is not None and previous != sha256:
+                self._release(previous)
+
+    def remove(self, path, sha256=None):
+        """Remove a file and release its blob.
+
+        Return True if the blob of the file was removed as well.
+        """
+        with self._lock:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            if sha256 is None:
+                return False
+            return self._release(sha256)
+
+    def collect(self):
+        """Remove the blobs no longer referenced, return their number."""
+        if not os.path.isdir(self.path):
+            return 0
+        collected = 0
+        for sha256 in os.listdir(self.path):
+            with self._lock:
+                collected += self._release(sha256)
+        if collected:
+            logger.info('Collected %d unreferenced blobs', collected)
+        return collected
+
+    def stats(self):
+        """Return the deduplication counters."""
+        return {
+            'stored': self.stored,
+            'deduplicated': self.deduplicated,
+            'deduplicated_bytes': self.deduplicated_bytes,
+            'released': self.released,
+        }
@@ -0,0 +1,182 @@
+"""Block2 size policy module."""
+
+import json
+import time
+import logging
+import ipaddress
+
+from metrics import Counter, TRANSFER_IDLE_TIMEOUT
+
+logger = logging.getLogger("otaserver")
+
+
+BLOCK_SZX = 6
+BLOCK_MAX_SZX = 6
+
+
+def block_size(szx):
+    """Return the size in bytes of the blocks of a size exponent."""
+    return 2 ** (szx + 4)
+
+
+class BlockPolicy():
+    """Size of the blocks served to the devices.
+
+    Transfers started without a Block2 option use the default size exponent
+    and devices asking for larger blocks than the maximum size exponent get
+    smaller blocks, as allowed by RFC 7959. The default and maximum can be
+    set per publish identifier and per remote network, the longest matching
+    prefix winning. The default of a remote network takes precedence over
+    the one of a publish identifier and both maximums apply.
+
+    In measurement mode, the duration of each transfer is recorded per size
+    exponent and the default size exponent cycles over the allowed ones, so
+    the best block size of a deployment can be picked from the data.
+    """
+
+    def __init__(self, default=BLOCK_SZX, maximum=BLOCK_MAX_SZX,
+                 publish_ids=None, remotes=None, measure=False):
+        self.default = default
+        self.maximum = maximum
+        self.publish_ids = publish_ids or {}
+        self.remotes = sorted(
+            ((ipaddress.ip_network(prefix, strict=False), rule)
+             for prefix, rule in (remotes or {}).items()),
+            key=lambda remote: remote[0].prefixlen, reverse=True)
+        self.measure = measure
+        self.transfers = Counter('otaserver_coap_block_transfers_total',
+                                 'Completed file transfers per block size.',
+                                 ('szx',))
+        self.bytes = Counter('otaserver_coap_block_transfer_bytes_total',
+                             'Bytes of the completed file transfers per '
+                             'block size.', ('szx',))
+        self.seconds = Counter('otaserver_coap_block_transfer_seconds_total',
+                               'Duration of the completed file transfers per '
+                               'block size.', ('szx',))
+        self._remote_rules = {}
+        self._started = {}
+        self._cycle = 0
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Load the per publish identifier and remote rules of a JSON file.
+
+        The file contains a `publish_ids` and a `remotes` object, mapping
+        publish identifiers and network prefixes to objects with optional
+        `default` and `maximum` size exponents.
+        """
+        with open(path) as f:
+            rules = json.load(f)
+        return cls(publish_ids=rules.get('publish_ids'),
+                   remotes=rules.get('remotes'), **kwargs)
+
+    def _remote_rule(self, remote):
+        if remote not in self._remote_rules:
+            rule = {}
+            try:
+                address = ipaddress.ip_address(remote)
+            except ValueError:
+                address = None
+            for network, network_rule in self.remotes:
+                if address is not None and address in network:
+                    rule = network_rule
+                    break
+            self._remote_rules[remote] = rule
+        return self._remote_rules[remote]
+
+    def limits(self, remote, publish_id):
+        """Return the default and maximum size exponents of a transfer."""
+        publish_rule = self.publish_ids.get(publish_id, {})
+        remote_rule = self._remote_rule(remote)
+        maximum = min(remote_rule.get('maximum', self.maximum),
+                      publish_rule.get('maximum', self.maximum))
+        default = remote_rule.get(
+            'default', publish_rule.get('default', self.default))
+        return min(default, maximum), maximum
+
+    def negotiate(self, remote, publish_id, block):
+        """Return the block number and size exponent of the block served.
+
+        `block` is the Block2 option of the request, None if missing.
+        """
+        default, maximum = self.limits(remote, publish_id)
+        if block is None:
+            if self.measure:
+                # Spread the new transfers over the allowed sizes
+                self._cycle += 1
+                return 0, self._cycle % (maximum + 1)
+            return 0, default
+        if block.size_exponent <= maximum:
+            return block.block_number, block.size_exponent
+        # Serve the smaller block starting at the same offset
+        return (block.block_number * 2 ** (block.size_exponent - maximum),
+                maximum)
+
+    def record_block(self, remote, path, block_number, szx, size, more):
+        """Record a served block, in measurement mode."""
+        if not self.measure:
+            return
+        now = time.perf_counter()
+        transfer = (remote, path)
+        if block_number == 0:
+            self._started[transfer] = (now, 0, now)
+        started = self._started.get(transfer)
+        if started is None:
+            return
+        start, size_sent, _ = started
+        size_sent += size
+        if more:
+            self._started[transfer] = (start, size_sent, now)
+            return
+        del self._started[transfer]
+        labels = (szx,)
+        self.transfers.inc(labels)
+        self.bytes.inc(labels, size_sent)
+        self.seconds.inc(labels, now - start)
+
+    def _expire(self):
+        expiry = time.perf_counter() - TRANSFER_IDLE_TIMEOUT
+        self._started = {transfer: started for transfer, started
+                         in self._started.items() if started[2] > expiry}
+
+    def stats(self):
+        """Return the policy and the measures per block size."""
+        self._expire()
+        measures = {}
+        for labels, transfers in sorted(self.transfers.values.items()):
+            seconds = self.seconds.values[labels]
+            measures[block_size(labels[0])] = {
+                'szx': labels[0],
+                'transfers': transfers,
+                'bytes': self.bytes.values[labels],
+                'seconds': seconds,
+                'bytes_per_second': (self.bytes.values[labels] / seconds
+                                     if seconds else None),
+            }
+        return {
+            'default': self.default,
+            'maximum': self.maximum,
+            'publish_ids': self.publish_ids,
+            'remotes': {str(network): rule for network, rule in self.remotes},
+            'measure': self.measure,
+            'measures': measures,
+        }
+
+    def snapshot(self):
+        """Return the measures, to be loaded by another process."""
+        return {metric.name: metric.values
+                for metric in (self.transfers, self.bytes, self.seconds)}
+
+    def load(self, snapshots):
+        """Set the measures to the merged snapshots of several processes."""
+        for metric in (self.transfers, self.bytes, self.seconds):
+            metric.load(snapshot.get(metric.name, {})
+                        for snapshot in snapshots)
+
+    def render(self):
+        """Return the measures in the Prometheus text exposition format."""
+        self._expire()
+        lines = []
+        for metric in (self.transfers, self.bytes, self.seconds):
+            lines += metric.render()
+        return lines
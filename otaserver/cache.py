@@ -0,0 +1,117 @@
+"""Firmware content cache module."""
+
+import asyncio
+import hashlib
+import logging
+
+from collections import OrderedDict
+
+from storage import _read_file
+
+logger = logging.getLogger("otaserver")
+
+
+CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+
+def _load_file(path):
+    # Runs in a storage worker, hashing releases the GIL
+    data = _read_file(path)
+    return memoryview(data), hashlib.sha256(data).hexdigest()
+
+
+class FirmwareCache():
+    """Size-bounded LRU cache holding the content of firmware files.
+
+    Each file is read from disk once and kept in memory as a memoryview, so
+    blocks can be sliced from it without copying, along with the digest of
+    the loaded content. Entries are indexed by the file path or, when known,
+    by the expected digest of the file content so files sharing the same
+    content share a single entry. Loaded content is only indexed by the
+    expected digest if it matches, a file replaced on disk since its digest
+    was known is indexed by its path. When a storage is given, files are
+    loaded and hashed in its worker threads.
+    """
+
+    def __init__(self, max_size=CACHE_MAX_SIZE, storage=None):
+        self.max_size = max_size
+        self.storage = storage
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+
+    async def get(self, path, sha256=None):
+        """Return the content of the file at path and its digest, loading it
+        if needed.
+
+        The content is cached under its expected digest `sha256` if given
+        and matching, under the path otherwise.
+        """
+        key = sha256 if sha256 is not None else path
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        # Concurrent requests of the same content share a single load
+        loading = self._loading.get(key)
+        if loading is None:
+            loading = (asyncio.ensure_future(self._load(path)), path)
+            self._loading[key] = loading
+        try:
+            entry = await asyncio.shield(loading[0])
+        finally:
+            if self._loading.get(key) is loading:
+                del self._loading[key]
+                future, loaded_path = loading
+                if (future.done() and not future.cancelled() and
+                        future.exception() is None):
+                    if key == loaded_path or future.result()[1] == key:
+                        self._put(key, future.result())
+                    else:
+                        logger.debug("File %s changed since its digest was "
+                                     "known", loaded_path)
+                        self._put(loaded_path, future.result())
+        if sha256 is not None and entry[1] != sha256 and loading[1] != path:
+            # Another file expected to have the same content was loaded
+            return await self.get(path)
+        return entry
+
+    async def _load(self, path):
+        if self.storage is not None:
+            return await self.storage.run(_load_file, path)
+        return _load_file(path)
+
+    def _put(self, key, entry):
+        size = len(entry[0])
+        if size > self.max_size:
+            logger.debug("File %s is too large to be cached", key)
+            return
+        self.invalidate(key)
+        while self._entries and self.size + size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted[0])
+        self._entries[key] = entry
+        self.size += size
+
+    def invalidate(self, key):
+        """Drop the cached content of a file path or digest."""
+        # A load in progress may return stale content, don't keep it
+        self._loading.pop(key, None)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def stats(self):
+        """Return the cache counters."""
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,183 @@
+"""Notification campaigns module."""
+
+import time
+import uuid
+import asyncio
+import logging
+
+from collections import OrderedDict
+
+from aiocoap.numbers.codes import Code
+
+from coap import url_host
+from notify import NOTIFY_TIMEOUT
+
+logger = logging.getLogger("otaserver")
+
+
+CAMPAIGN_RATE = 10
+CAMPAIGN_MAX_ACTIVE = 50
+CAMPAIGN_DOWNLOAD_TIMEOUT = 600
+CAMPAIGN_HISTORY = 100
+
+ACTIVE_STATES = ('notifying', 'downloading')
+
+
+class Campaign():
+    """Notification of an update to a list of devices, in waves.
+
+    Devices are notified at most `rate` per second and no more than
+    `max_active` devices are being notified or downloading the update at
+    the same time. When downloads are tracked, a device is done once it
+    fetched the last block of a slot image, or failed if it didn't within
+    `download_timeout` seconds. Devices are identified by the host of their
+    url, a transfer from a host shared by several devices completes the
+    device of the host notified first.
+    """
+
+    def __init__(self, publish_id, urls, notify_device,
+                 rate=CAMPAIGN_RATE, max_active=CAMPAIGN_MAX_ACTIVE,
+                 notify_timeout=NOTIFY_TIMEOUT,
+                 download_timeout=CAMPAIGN_DOWNLOAD_TIMEOUT,
+                 track_downloads=True):
+        if not rate > 0:
+            raise ValueError('Campaign rate must be positive')
+        if max_active < 1:
+            raise ValueError('Campaign max_active must be at least 1')
+        self.id = uuid.uuid4().hex
+        self.publish_id = publish_id
+        self.rate = rate
+        self.max_active = max_active
+        self.notify_timeout = notify_timeout
+        self.download_timeout = download_timeout
+        self.track_downloads = track_downloads
+        self.created = time.time()
+        self.finished = None
+        self.devices = OrderedDict(
+            (url, {'state': 'pending', 'notified': None, 'done': None})
+            for url in urls)
+        # Devices behind the same host can't be told apart by their address
+        self._hosts = {}
+        for url in self.devices:
+            self._hosts.setdefault(url_host(url), []).append(url)
+        self._notify_device = notify_device
+        self._tasks = set()
+
+    def _active(self):
+        return sum(1 for device in self.devices.values()
+                   if device['state'] in ACTIVE_STATES)
+
+    def _expire_downloads(self):
+        now = time.time()
+        for url, device in self.devices.items():
+            if device['state'] == 'downloading' and \
+                    now - device['notified'] > self.download_timeout:
+                logger.debug('Download of %s timed out', url)
+                device['state'] = 'failed'
+                device['error'] = 'Download timeout'
+
+    async def _notify(self, url):
+        device = self.devices[url]
+        device['state'] = 'notifying'
+        try:
+            code, payload = await asyncio.wait_for(self._notify_device(url),
+                                                   self.notify_timeout)
+        except Exception as exc:
+            device['state'] = 'failed'
+            device['error'] = str(exc) or type(exc).__name__
+            return
+        device['notified'] = time.time()
+        if device['state'] == 'done':
+            # The device downloaded the update before answering the trigger
+            return
+        if not isinstance(code, Code) or not code.is_successful():
+            device['state'] = 'failed'
+            device['error'] = '{}: {}'.format(code, payload)
+        elif self.track_downloads:
+            device['state'] = 'downloading'
+        else:
+            device['state'] = 'notified'
+
+    async def run(self):
+        """Notify all devices of the campaign."""
+        interval = 1.0 / self.rate
+        logger.debug('Starting campaign %s for %d devices of %s',
+                      self.id, len(self.devices), self.publish_id)
+        for url in self.devices:
+            self._expire_downloads()
+            while self._active() >= self.max_active:
+                await asyncio.sleep(interval)
+                self._expire_downloads()
+            task = asyncio.ensure_future(self._notify(url))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            await asyncio.sleep(interval)
+        while self._active() > 0:
+            await asyncio.sleep(interval)
+            self._expire_downloads()
+        self.finished = time.time()
+        logger.debug('Campaign %s finished', self.id)
+
+    def transfer_done(self, remote, publish_id, filename):
+        """Mark a device as done when it downloaded a slot image."""
+        if publish_id != self.publish_id or 'suit' in filename:
+            return
+        # The transfer is attributed to the device of the host notified
+        # first, devices still being notified come last
+        active = [url for url in self._hosts.get(remote, ())
+                  if self.devices[url]['state'] in ACTIVE_STATES]
+        if not active:
+            return
+        url = min(active, key=lambda url: (
+            self.devices[url]['notified'] is None,
+            self.devices[url]['notified'] or 0))
+        self.devices[url]['state'] = 'done'
+        self.devices[url]['done'] = time.time()
+
+    def progress(self, with_devices=True):
+        """Return the progress of the campaign."""
+        states = {}
+        for device in self.devices.values():
+            states[device['state']] = states.get(device['state'], 0) + 1
+        progress = {
+            'id': self.id,
+            'publish_id': self.publish_id,
+            'rate': self.rate,
+            'max_active': self.max_active,
+            'created': self.created,
+            'finished': self.finished,
+            'states': states,
+        }
+        if with_devices:
+            progress['devices'] = self.devices
+        return progress
+
+
+class CampaignScheduler():
+    """Run notification campaigns and track their progress.
+
+    Only the `history` most recent finished campaigns are kept.
+    """
+
+    def __init__(self, history=CAMPAIGN_HISTORY):
+        self.history = history
+        self.campaigns = OrderedDict()
+
+    def _evict(self):
+        finished = [campaign_id for campaign_id, campaign
+                    in self.campaigns.items() if campaign.finished is not None]
+        for campaign_id in finished[:max(0, len(finished) - self.history)]:
+            del self.campaigns[campaign_id]
+
+    def submit(self, campaign):
+        """Schedule the notifications of a campaign."""
+        self._evict()
+        self.campaigns[campaign.id] = campaign
+        asyncio.ensure_future(campaign.run())
+        return campaign
+
+    def transfer_done(self, remote, publish_id, filename):
+        """Forward the end of a file transfer to the running campaigns."""
+        for campaign in self.campaigns.values():
+            if campaign.finished is None:
+                campaign.transfer_done(remote, publish_id, filename)
@@ -0,0 +1,448 @@
+"""Firmware catalog module."""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import asyncio
+import logging
+
+from collections import defaultdict
+
+logger = logging.getLogger("otaserver")
+
+METADATA_FILE = '.metadata.json'
+SNAPSHOT_FILE = '.catalog.json'
+SNAPSHOT_DELAY = 1
+DELTA_SUFFIX = '.delta'
+# Suffixes of the compressed variants of the slot images, per format
+COMPRESSED_SUFFIXES = {'deflate': '.deflate', 'lz4': '.lz4'}
+
+
+def version_key(version):
+    """Sort key of versions, numeric versions being compared as numbers."""
+    if version.isdigit():
+        return (0, int(version), version)
+    return (1, 0, version)
+
+
+def _read_metadata(store_path):
+    try:
+        with open(os.path.join(store_path, METADATA_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_metadata(store_path, metadata):
+    _path = os.path.join(store_path, METADATA_FILE)
+    _tmp_path = '{}.{}'.format(_path, uuid.uuid4().hex)
+    with open(_tmp_path, 'w') as f:
+        json.dump(metadata, f)
+    os.replace(_tmp_path, _path)
+
+
+def _write_snapshot(upload_path, snapshot):
+    _path = os.path.join(upload_path, SNAPSHOT_FILE)
+    _tmp_path = '{}.{}'.format(_path, uuid.uuid4().hex)
+    with open(_tmp_path, 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(_tmp_path, _path)
+
+
+def _scan_application(store_path):
+    files = set(file for file in os.listdir(store_path)
+                if not file.startswith('.'))
+    return files, _read_metadata(store_path)
+
+
+def _describe_files(store_path, filenames):
+    # Runs in a storage worker
+    descriptions = []
+    for filename in filenames:
+        _path = os.path.join(store_path, filename)
+        sha256 = hashlib.sha256()
+        try:
+            with open(_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    sha256.update(chunk)
+            descriptions.append((os.path.getsize(_path), sha256.hexdigest(),
+                                 os.path.getmtime(_path)))
+        except OSError:
+            descriptions.append(None)
+    return descriptions
+
+
+def compressed_format(filename):
+    """Return the format of a compressed variant, None for other files."""
+    for name, suffix in COMPRESSED_SUFFIXES.items():
+        if filename.endswith(suffix):
+            return name
+    return None
+
+
+def file_version(filename):
+    """Return the version of a file, None for the latest aliases.
+
+    The version of a patch is the version it updates to.
+    """
+    compressed = compressed_format(filename)
+    if compressed is not None:
+        filename = filename[:-len(COMPRESSED_SUFFIXES[compressed])]
+    if filename.endswith(DELTA_SUFFIX):
+        return filename[:-len(DELTA_SUFFIX)].split('.')[-1].partition('-')[2]
+    version = filename.split('.')[-2]
+    if version == 'latest':
+        return None
+    if version == 'riot':
+        version = filename.split('.')[-3]
+    return version
+
+
+def _get_version_files(files):
+    version_files = defaultdict(set)
+    for file in files:
+        version = file_version(file)
+        if version is None:
+            continue
+        version_files[version].add(file)
+        if file.endswith(DELTA_SUFFIX):
+            # Patches from a version are useless without it
+            old = file[:-len(DELTA_SUFFIX)].split('.')[-1].partition('-')[0]
+            version_files[old].add(file)
+    return version_files
+
+
+def _get_versions(files):
+    versions = defaultdict(dict)
+    for file in files:
+        compressed = compressed_format(file)
+        if compressed is not None:
+            # Variant of a slot image, named <slot image><suffix>
+            base = file[:-len(COMPRESSED_SUFFIXES[compressed])]
+            slot = 'slot1' if 'slot1' in base else 'slot0'
+            versions[base.split('.')[-2]].setdefault(
+                'compressed', {}).setdefault(compressed, {})[slot] = file
+            continue
+        if file.endswith(DELTA_SUFFIX):
+            # Patch from an old version, named <base>.<old>-<new>.delta
+            old, _, new = file[:-len(DELTA_SUFFIX)].split('.')[-1].partition(
+                '-')
+            slot = 'slot1' if 'slot1' in file else 'slot0'
+            versions[new].setdefault('deltas', {}).setdefault(
+                old, {})[slot] = file
+            continue
+        version = file.split('.')[-2]
+        if version == 'latest':
+            continue
+        if version == 'riot':
+            version = file.split('.')[-3]
+        if 'riot.suit' in file:
+            versions[version]['manifest'] = file
+        elif 'slot0' in file:
+            versions[version]['slot0'] = file
+        elif 'slot1' in file:
+            versions[version]['slot1'] = file
+    return versions
+
+
+class FirmwareCatalog():
+    """In-memory index of the firmware files available in the upload path.
+
+    The catalog is built once from the upload path and then kept up to date
+    by the publish and remove handlers, so listing applications and versions
+    doesn't touch the disk. The size and SHA-256 digest of each file,
+    computed at publish time, and the multicast group of the application are
+    persisted in a metadata file stored in each application directory.
+    `listeners` are called with the publish identifier of an application
+    once its metadata is persisted.
+
+    When `snapshot` is set, the whole catalog is also persisted in a
+    snapshot file of the upload path, after changes and at shutdown, so a
+    restarted server loads the snapshot instead of scanning the upload path
+    and reconciles it with the upload path in the background.
+    """
+
+    def __init__(self, upload_path, snapshot=False):
+        self.upload_path = upload_path
+        self.snapshot = snapshot
+        self.listeners = []
+        self._files = {}
+        self._versions = {}
+        self._version_files = {}
+        self._metadata = {}
+        self._groups = {}
+        self._changes = {}
+        self._snapshot = None
+
+    def _changed(self, publish_id):
+        self._versions.pop(publish_id, None)
+        self._version_files.pop(publish_id, None)
+        self._changes[publish_id] = self._changes.get(publish_id, 0) + 1
+
+    def build(self):
+        """Scan the upload path and index all the available files."""
+        self._files = {}
+        self._versions = {}
+        self._version_files = {}
+        self._metadata = {}
+        self._groups = {}
+        for publish_id in os.listdir(self.upload_path):
+            if publish_id.startswith('.'):
+                continue
+            self._load(publish_id, *_scan_application(
+                os.path.join(self.upload_path, publish_id)))
+        logger.debug('Firmware catalog built with %d applications',
+                     len(self._files))
+
+    def _load(self, publish_id, files, metadata):
+        self._files[publish_id] = files
+        self._metadata[publish_id] = metadata.get('files', {})
+        self._groups.pop(publish_id, None)
+        if metadata.get('multicast_group'):
+            self._groups[publish_id] = metadata['multicast_group']
+        self._changed(publish_id)
+
+    def load_snapshot(self):
+        """Load the catalog from its snapshot, return False if missing or
+        invalid."""
+        try:
+            with open(os.path.join(self.upload_path, SNAPSHOT_FILE)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self._files = {}
+        self._versions = {}
+        self._version_files = {}
+        self._metadata = {}
+        self._groups = {}
+        try:
+            for publish_id, application in snapshot['applications'].items():
+                # Entries have the metadata of the application and its files
+                self._load(publish_id, set(application['names']), application)
+        except (KeyError, TypeError, AttributeError) as exc:
+            logger.warning('Invalid catalog snapshot (%s), scanning the '
+                           'upload path', exc)
+            self._files = {}
+            self._versions = {}
+            self._version_files = {}
+            self._metadata = {}
+            self._groups = {}
+            return False
+        return True
+
+    def _snapshot_content(self):
+        return {'applications': {
+            publish_id: {
+                'names': sorted(files),
+                'files': dict(self._metadata.get(publish_id, {})),
+                'multicast_group': self._groups.get(publish_id),
+            } for publish_id, files in self._files.items()}}
+
+    def write_snapshot(self):
+        """Persist the snapshot of the catalog now, blocking."""
+        if self._snapshot is not None:
+            self._snapshot.cancel()
+            self._snapshot = None
+        if self.snapshot:
+            _write_snapshot(self.upload_path, self._snapshot_content())
+
+    async def _save_snapshot(self, storage):
+        # Changes made during the delay are saved together
+        await asyncio.sleep(SNAPSHOT_DELAY)
+        self._snapshot = None
+        await storage.run(_write_snapshot, self.upload_path,
+                          self._snapshot_content())
+
+    def save_snapshot(self, storage):
+        """Persist the snapshot of the catalog soon, using the storage."""
+        if self.snapshot and self._snapshot is None:
+            self._snapshot = asyncio.ensure_future(self._save_snapshot(storage))
+
+    async def reconcile(self, storage):
+        """Update the catalog loaded from a snapshot with the upload path.
+
+        Applications changed since the snapshot are loaded again, except if
+        they changed in the meantime, and the listeners are called. Return
+        the list of the updated applications.
+        """
+        publish_ids = set(publish_id for publish_id
+                          in await storage.listdir(self.upload_path)
+                          if not publish_id.startswith('.'))
+        updated = []
+        for publish_id in sorted(publish_ids | set(self._files)):
+            changes = self._changes.get(publish_id)
+            if publish_id in publish_ids:
+                try:
+                    files, metadata = await storage.run(
+                        _scan_application,
+                        os.path.join(self.upload_path, publish_id))
+                except FileNotFoundError:
+                    files, metadata = set(), {}
+            else:
+                files, metadata = set(), {}
+            if changes != self._changes.get(publish_id):
+                continue
+            if files == self._files.get(publish_id) and \
+                    metadata.get('files', {}) == \
+                    self._metadata.get(publish_id, {}) and \
+                    metadata.get('multicast_group') == \
+                    self._groups.get(publish_id):
+                continue
+            if files:
+                self._load(publish_id, files, metadata)
+            else:
+                self._drop(publish_id)
+            updated.append(publish_id)
+        for publish_id in updated:
+            for listener in self.listeners:
+                listener(publish_id)
+        if updated:
+            self.save_snapshot(storage)
+        return updated
+
+    async def complete_metadata(self, storage):
+        """Compute and persist the metadata of the files published without.
+
+        Files stored before their size and digest were recorded at publish
+        time are hashed by the storage workers and their file time is used
+        as their publish time. Applications changed in the meantime are
+        skipped. Return the number of files described.
+        """
+        described = 0
+        for publish_id in sorted(self._files):
+            filenames = sorted(filename for filename
+                               in self._files.get(publish_id, ())
+                               if self.metadata(publish_id, filename) is None)
+            if not filenames:
+                continue
+            changes = self._changes.get(publish_id)
+            descriptions = await storage.run(
+                _describe_files, os.path.join(self.upload_path, publish_id),
+                filenames)
+            if changes != self._changes.get(publish_id):
+                continue
+            for filename, description in zip(filenames, descriptions):
+                if description is None:
+                    continue
+                size, sha256, mtime = description
+                self.set_metadata(publish_id, filename, size, sha256,
+                                  published=mtime)
+                described += 1
+            await self.save_metadata(storage, publish_id)
+        return described
+
+    def _drop(self, publish_id):
+        self._files.pop(publish_id, None)
+        self._metadata.pop(publish_id, None)
+        self._groups.pop(publish_id, None)
+        self._changed(publish_id)
+
+    async def reload(self, storage, publish_id):
+        """Index again the files of an application, using the storage."""
+        try:
+            files, metadata = await storage.run(
+                _scan_application,
+                os.path.join(self.upload_path, publish_id))
+        except FileNotFoundError:
+            files, metadata = set(), {}
+        self._load(publish_id, files, metadata)
+
+    def add(self, publish_id, filename):
+        """Index a new file of an application."""
+        self._files.setdefault(publish_id, set()).add(filename)
+        self._changed(publish_id)
+
+    def remove(self, publish_id, filename):
+        """Drop a file of an application from the index."""
+        self._files.get(publish_id, set()).discard(filename)
+        self._metadata.get(publish_id, {}).pop(filename, None)
+        self._changed(publish_id)
+
+    def metadata(self, publish_id, filename):
+        """Return the size and digest of a file, None if unknown."""
+        return self._metadata.get(publish_id, {}).get(filename)
+
+    def set_metadata(self, publish_id, filename, size, sha256,
+                     published=None):
+        """Set the size and digest of a file, published now by default."""
+        self._metadata.setdefault(publish_id, {})[filename] = {
+            'size': size, 'sha256': sha256,
+            'published': published if published is not None else time.time()}
+        self._changes[publish_id] = self._changes.get(publish_id, 0) + 1
+
+    def multicast_group(self, publish_id):
+        """Return the multicast group of an application, None if unset."""
+        return self._groups.get(publish_id)
+
+    def set_multicast_group(self, publish_id, group):
+        """Set the multicast group notified of the application updates."""
+        self._groups[publish_id] = group
+        self._changes[publish_id] = self._changes.get(publish_id, 0) + 1
+
+    async def save_metadata(self, storage, publish_id):
+        """Persist the metadata of an application using the storage."""
+        if publish_id not in self._files:
+            return
+        metadata = {
+            'files': dict(self._metadata.get(publish_id, {})),
+            'multicast_group': self._groups.get(publish_id),
+        }
+        await storage.run(_write_metadata,
+                          os.path.join(self.upload_path, publish_id),
+                          metadata)
+        for listener in self.listeners:
+            listener(publish_id)
+        self.save_snapshot(storage)
+
+    def stats(self):
+        """Return the number of indexed applications and files."""
+        return {
+            'applications': len(self._files),
+            'files': sum(len(files) for files in self._files.values()),
+        }
+
+    def contains(self, publish_id, filename):
+        """True if the file of an application is indexed."""
+        return filename in self._files.get(publish_id, ())
+
+    def publish_ids(self):
+        """Return the list of indexed applications."""
+        return list(self._files)
+
+    def files(self, publish_id):
+        """Return the list of files of an application."""
+        return sorted(self._files.get(publish_id, ()))
+
+    def versions(self, publish_id):
+        """Return the files of an application grouped by version."""
+        if publish_id not in self._versions:
+            self._versions[publish_id] = _get_versions(
+                self._files.get(publish_id, ()))
+        return self._versions[publish_id]
+
+    def version_files(self, publish_id, version):
+        """Return the files of a version of an application.
+
+        Files are matched exactly against the version, they include the
+        patches to and from the version but not the latest aliases.
+        """
+        if publish_id not in self._version_files:
+            self._version_files[publish_id] = _get_version_files(
+                self._files.get(publish_id, ()))
+        return sorted(self._version_files[publish_id].get(version, ()))
+
+    def applications(self):
+        """Return the description of all indexed applications."""
+        applications = []
+        for publish_id, files in sorted(self._files.items()):
+            board, name = publish_id.split('_', 1)
+            applications.append(
+                { 'id': publish_id,
+                  'name': name,
+                  'board': board,
+                  'count': len(self.versions(publish_id)),
+                  'versions': self.versions(publish_id)
+                })
+        return applications
@@ -1,13 +1,21 @@
 """CoAP management module."""
 
 import os
+import time
 import asyncio
+import ipaddress
 import logging
 import mimetypes
 import aiocoap
 import aiocoap.resource as resource
 
-from aiocoap import Context, Message, CONTENT, NOT_FOUND, POST
+from aiocoap import Context, Message, CONTENT, VALID, NOT_FOUND, POST, CON
+
+from cache import FirmwareCache
+from catalog import FirmwareCatalog, file_version
+from metrics import CoapMetrics
+from blocks import BlockPolicy
+from compress import content_format
 
 logger = logging.getLogger("otaserver")
 
@@ -15,6 +23,19 @@ logger = logging.getLogger("otaserver")
 COAP_METHOD = 'coap'
 COAP_PORT = 5683
 COAP_HOST = '[::1]'
+COAP_CLIENT_POOL_SIZE = 1
+
+
+def normalize_address(host):
+    """Return the canonical form of an address, IPv4-mapped IPv6 addresses
+    being returned as IPv4 addresses. Host names are returned unchanged."""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return host
+    if address.version == 6 and address.ipv4_mapped is not None:
+        return str(address.ipv4_mapped)
+    return str(address)
 
 
 def _remote_address(request):
@@ -22,80 +43,291 @@ def _remote_address(request):
         remote = request.remote[0]
     except TypeError:
         remote = request.remote.sockaddr[0]
-    return remote
+    # The server socket is dual-stack, IPv4 peers have mapped addresses
+    return normalize_address(remote)
+
+
+def url_host(url):
+    """Return the normalized host address of a device url."""
+    if url.startswith('['):
+        return normalize_address(url[1:url.index(']')])
+    host = url.split('/')[0]
+    if host.count(':') == 1:
+        host = host.split(':')[0]
+    return normalize_address(host)
+
+
+def _etag(sha256):
+    return bytes.fromhex(sha256)[:8]
 
 
 class FileResource(resource.Resource):
-    """CoAP resource returning the content of a binary file."""
+    """CoAP resource returning the content of a binary file.
+
+    Each block carries the ETag and Size2 options of the loaded file and GET
+    requests with a matching ETag are answered with 2.03 Valid. Blocks of
+    compressed variants also carry the content format of their compression.
+    """
 
-    def __init__(self, controller, file_path):
+    def __init__(self, controller, publish_id, filename):
         super(FileResource, self).__init__()
         self._controller = controller
-        self._file_path = file_path
+        self._publish_id = publish_id
+        self._filename = filename
+        self._file_path = os.path.join(controller.upload_path,
+                                       publish_id, filename)
+        self._content_format = content_format(filename)
 
     async def needs_blockwise_assembly(self, request):
         return False
 
     async def render_get(self, request):
         """Response to CoAP GET request."""
+        start = time.perf_counter()
         remote = _remote_address(request)
-        logger.debug("CoAP GET manifest received from {}".format(remote))
-        if not os.path.isfile(self._file_path):
+        logger.debug("CoAP GET manifest received from %s", remote)
+        self._controller.record_fetch(remote, self._publish_id)
+        # Files with the same content share their cache entry
+        metadata = self._controller.catalog.metadata(self._publish_id,
+                                                     self._filename)
+        sha256 = metadata['sha256'] if metadata is not None else None
+        try:
+            content, sha256 = await self._controller.cache.get(
+                self._file_path, sha256)
+        except FileNotFoundError:
             err_msg = "File {} not found on server".format(
                 self._file_path).encode()
             return Message(code=NOT_FOUND, payload=err_msg)
 
-        block_in = request.opt.block2 or \
-            aiocoap.optiontypes.BlockOption.BlockwiseTuple(0, 0, 6)
-        
-        with open(self._file_path, 'rb') as f:
-            f.seek(block_in.start)
-            data = f.read(block_in.size + 1)
+        # Options describe the content served, the catalog may be outdated
+        etag = _etag(sha256)
+        if etag in request.opt.etags:
+            return aiocoap.Message(code=VALID, etag=etag)
+
+        block_policy = self._controller.block_policy
+        block_number, szx = block_policy.negotiate(remote, self._publish_id,
+                                                   request.opt.block2)
+        block_in = aiocoap.optiontypes.BlockOption.BlockwiseTuple(
+            block_number, 0, szx)
+
+        data = content[block_in.start:block_in.start + block_in.size + 1]
 
         block_out = aiocoap.optiontypes.BlockOption.BlockwiseTuple(
             block_in.block_number,
             len(data) > block_in.size,
             block_in.size_exponent)
 
-        return aiocoap.Message(payload=data[:block_in.size], block2=block_out)
+        if not block_out.more:
+            self._controller.transfer_done(remote, self._publish_id,
+                                           self._filename)
+        self._controller.metrics.record_block(
+            remote, self._file_path, block_in.block_number,
+            min(len(data), block_in.size), block_out.more,
+            time.perf_counter() - start)
+        block_policy.record_block(
+            remote, self._file_path, block_in.block_number, szx,
+            min(len(data), block_in.size), block_out.more)
 
+        return aiocoap.Message(payload=data[:block_in.size], block2=block_out,
+                               etag=etag, size2=len(content),
+                               content_format=self._content_format)
+
+
+class ObservableFileResource(FileResource, resource.ObservableResource):
+    """CoAP resource of a latest manifest, observable as in RFC 7641.
+
+    Observers are notified with the new manifest when a new version of the
+    application is published, so devices don't need to be triggered.
+    """
+
+    def __init__(self, controller, publish_id, filename, on_unobserved):
+        super(ObservableFileResource, self).__init__(controller, publish_id,
+                                                     filename)
+        metadata = controller.catalog.metadata(publish_id, filename)
+        self.sha256 = metadata and metadata['sha256']
+        self.observations = 0
+        self._on_unobserved = on_unobserved
+
+    def update_observation_count(self, newcount):
+        self.observations = newcount
+        self._controller.metrics.set_observations(
+            (self._publish_id, self._filename), newcount)
+        if newcount == 0:
+            self._on_unobserved(self)
+
+
+class FirmwareSite(resource.Site):
+    """CoAP site resolving firmware files lazily against the catalog.
+
+    Requests to `<publish_id>/<file>` that don't match a statically
+    registered resource are served by a FileResource created on demand if
+    the file is in the catalog, so removed files disappear immediately and
+    no resource is kept per archived file. Latest manifests are served by
+    an ObservableFileResource kept while it's observed.
+    """
+
+    def __init__(self, controller):
+        super(FirmwareSite, self).__init__()
+        self._controller = controller
+        self._observables = {}
 
-class CoapServer():
+    def _find_child_and_pathstripped_message(self, request):
+        try:
+            return super(FirmwareSite, self)\
+                ._find_child_and_pathstripped_message(request)
+        except KeyError:
+            path = request.opt.uri_path
+            if len(path) != 2 or not self._controller.catalog.contains(*path):
+                raise
+        stripped = request.copy(uri_path=())
+        path = tuple(path)
+        if file_version(path[1]) is not None:
+            return FileResource(self._controller, *path), stripped
+        observable = self._observables.get(path)
+        if observable is None:
+            observable = ObservableFileResource(self._controller, *path,
+                                                self._unobserved)
+            self._observables[path] = observable
+        return observable, stripped
+
+    def _unobserved(self, observable):
+        path = (observable._publish_id, observable._filename)
+        if self._observables.get(path) is observable:
+            del self._observables[path]
+
+    def updated(self, publish_id):
+        """Notify the observers of the latest manifests of an application
+        that changed."""
+        catalog = self._controller.catalog
+        for path, observable in list(self._observables.items()):
+            if path[0] != publish_id:
+                continue
+            metadata = catalog.metadata(*path)
+            sha256 = metadata and metadata['sha256']
+            if sha256 == observable.sha256 and catalog.contains(*path):
+                continue
+            logger.debug('Notifying %d observers of %s',
+                         observable.observations, '/'.join(path))
+            observable.sha256 = sha256
+            observable.updated_state()
+
+
+class CoapTransfers():
+    """Base class of the CoAP servers, tracking the files fetched by the
+    remotes."""
+
+    def __init__(self):
+        self.fetches = {}
+        self.transfer_listeners = []
+
+    def record_fetch(self, remote, publish_id):
+        """Record that a remote fetched a file of an application."""
+        self.fetches[remote] = (publish_id, time.time())
+
+    def fetched_since(self, remote, publish_id, since):
+        """True if a remote fetched a file of an application since then."""
+        fetch = self.fetches.get(remote)
+        return fetch is not None and fetch[0] == publish_id and \
+            fetch[1] >= since
+
+    def transfer_done(self, remote, publish_id, filename):
+        """Notify the listeners that a remote fetched the last block of a
+        file."""
+        for listener in self.transfer_listeners:
+            listener(remote, publish_id, filename)
+
+
+class CoapServer(CoapTransfers):
     """CoAP server."""
 
-    def __init__(self, upload_path, port=COAP_PORT):
-        self.root_coap = resource.Site()
+    def __init__(self, upload_path, port=COAP_PORT, cache=None, catalog=None,
+                 block_policy=None):
+        super(CoapServer, self).__init__()
+        self.root_coap = FirmwareSite(self)
         self.port = port
         self.upload_path = upload_path
-        self._bootstrap_resources()
-        asyncio.ensure_future(Context.create_server_context(self.root_coap,
-                              bind=('::', self.port)))
+        self.cache = cache if cache is not None else FirmwareCache()
+        if catalog is None:
+            catalog = FirmwareCatalog(upload_path)
+            catalog.build()
+        self.catalog = catalog
+        self.block_policy = block_policy if block_policy is not None \
+            else BlockPolicy()
+        self.metrics = CoapMetrics()
+        self.catalog.listeners.append(self.root_coap.updated)
+        self.context = asyncio.ensure_future(Context.create_server_context(
+            self.root_coap, bind=('::', self.port)))
 
-    def _bootstrap_resources(self):
-        for version in os.listdir(os.path.join(self.upload_path)):
-            self.add_resources(version)
+    async def collect(self):
+        """Update the metrics, they are always up to date in process."""
 
-    def add_resources(self, store_path):
-        """Add new resources for the given timestamp."""
-        for file in os.listdir(os.path.join(self.upload_path, store_path)):
-            self.add_resource(store_path, file)
+    def cache_stats(self):
+        """Return the counters of the firmware content cache."""
+        return self.cache.stats()
 
-    def add_resource(self, store_path, resource):
-        _resource_url = [store_path, resource,]
-        _resource_file = os.path.join(self.upload_path, store_path, resource)
-        self.root_coap.add_resource(_resource_url,
-                                    FileResource(self, _resource_file))
+    async def shutdown(self):
+        """Release the CoAP endpoint of the server."""
+        context = await self.context
+        await context.shutdown()
+        logger.debug('CoAP server stopped')
+
+
+class CoapClient():
+    """Pool of long-lived CoAP client contexts used for outgoing requests."""
+
+    def __init__(self, size=COAP_CLIENT_POOL_SIZE):
+        self.size = size
+        self._contexts = []
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        """Create the client contexts of the pool."""
+        async with self._lock:
+            while len(self._contexts) < self.size:
+                self._contexts.append(
+                    await Context.create_client_context(loop=None))
+        logger.debug('CoAP client pool started with %d contexts', self.size)
 
+    async def context(self):
+        """Return the next client context of the pool."""
+        if len(self._contexts) < self.size:
+            await self.start()
+        context = self._contexts[self._next % len(self._contexts)]
+        self._next += 1
+        return context
 
-async def coap_request(url, method=POST, payload=b''):
-    """Send a CoAP request containing an update notification."""
+    async def shutdown(self):
+        """Shutdown all client contexts of the pool."""
+        contexts, self._contexts = self._contexts, []
+        for context in contexts:
+            await context.shutdown()
+        logger.debug('CoAP client pool stopped')
+
+
+async def coap_request(url, method=POST, payload=b'', client=None,
+                       mtype=CON, timeout=None):
+    """Send a CoAP request containing an update notification.
+
+    When a client pool is given, the request is sent using one of its
+    contexts, otherwise a temporary client context is created. When a timeout
+    is given, waiting for the response stops after `timeout` seconds, which
+    is useful for NON requests sent to multicast groups.
+    """
     logger.debug('Sending a CoAP request to url: {}'.format(url))
-    context = await Context.create_client_context(loop=None)
-    request = Message(code=method, payload=payload)
+    if client is not None:
+        context = await client.context()
+    else:
+        context = await Context.create_client_context(loop=None)
+    request = Message(code=method, payload=payload, mtype=mtype)
     request_uri = '{}://{}'.format(COAP_METHOD, url)
     request.set_request_uri(request_uri)
     try:
-        response = await context.request(request).response
+        response = await asyncio.wait_for(context.request(request).response,
+                                          timeout)
+    except asyncio.TimeoutError:
+        code = "Timeout"
+        payload = 'No response after {}s'.format(timeout)
     except Exception as e:
         code = "Failed to fetch resource"
         payload = '{}'.format(e)
@@ -103,7 +335,8 @@ async def coap_request(url, method=POST, payload=b''):
         code = response.code
         payload = response.payload.decode('utf-8')
     finally:
-        await context.shutdown()
+        if client is None:
+            await context.shutdown()
 
     logger.debug('{}: {}'.format(code, payload))
     return code, payload
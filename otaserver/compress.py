@@ -0,0 +1,118 @@
+"""Compressed firmware variants module."""
+
+import os
+import uuid
+import zlib
+import hashlib
+import logging
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from catalog import COMPRESSED_SUFFIXES, DELTA_SUFFIX, compressed_format
+
+logger = logging.getLogger("otaserver")
+
+
+COMPRESS_FORMATS = ''
+# Devices decompress raw deflate streams with a 1KiB window
+DEFLATE_WBITS = 10
+# Variants saving less than this ratio of the original size are not kept
+COMPRESS_MIN_SAVING = 0.1
+# CoAP content formats from the experimental range, per format. Devices
+# decompress deflate streams with a 1KiB window and lz4 frames with a 64KiB
+# buffer: it's the smallest block size of the frames, whose blocks are
+# independent so no history is kept across blocks
+CONTENT_FORMATS = {'deflate': 65000, 'lz4': 65001}
+
+
+def compressed_filename(filename, name):
+    """Return the name of the variant of a file compressed in a format."""
+    return '{}{}'.format(filename, COMPRESSED_SUFFIXES[name])
+
+
+def content_format(filename):
+    """Return the CoAP content format of a file, None if unspecified."""
+    name = compressed_format(filename)
+    return CONTENT_FORMATS[name] if name is not None else None
+
+
+def _deflate(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -DEFLATE_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _lz4(data):
+    return lz4.frame.compress(data, block_size=lz4.frame.BLOCKSIZE_MAX64KB,
+                              block_linked=False,
+                              compression_level=lz4.frame.COMPRESSIONLEVEL_MAX)
+
+
+_COMPRESSORS = {'deflate': _deflate, 'lz4': _lz4}
+
+
+def _compress_file(path, name, tmp_dir):
+    # Runs in a storage worker, zlib and lz4 release the GIL
+    with open(path, 'rb') as f:
+        data = f.read()
+    content = _COMPRESSORS[name](data)
+    if len(content) > len(data) * (1 - COMPRESS_MIN_SAVING):
+        return None
+    _tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    with open(_tmp_path, 'wb') as f:
+        f.write(content)
+    return _tmp_path, len(content), hashlib.sha256(content).hexdigest()
+
+
+class Compressor():
+    """Generate compressed variants of the slot images at publish time.
+
+    Variants are stored next to the slot images, named after them with the
+    suffix of their format, and served as separate CoAP resources with an
+    experimental content format, so devices able to decompress them fetch
+    fewer blocks at no cost per request. `formats` lists the generated
+    formats: `deflate`, a raw deflate stream with a small window, and `lz4`,
+    an LZ4 frame which requires the lz4 package. Variants not significantly
+    smaller than their slot image are not kept.
+    """
+
+    def __init__(self, formats=()):
+        self.formats = []
+        for name in formats:
+            if name not in _COMPRESSORS:
+                logger.warning("Unknown compression format '%s'", name)
+            elif name == 'lz4' and lz4 is None:
+                logger.warning("lz4 is not installed, lz4 variants are "
+                               "disabled")
+            else:
+                self.formats.append(name)
+
+    @property
+    def enabled(self):
+        """True if variants are generated at publish time."""
+        return bool(self.formats)
+
+    def applies(self, filename):
+        """True if variants of a file are generated."""
+        return self.enabled and 'suit' not in filename and \
+            not filename.endswith(DELTA_SUFFIX) and \
+            compressed_format(filename) is None
+
+    async def compress(self, storage, path, tmp_dir):
+        """Compress a file in all the formats.
+
+        Return the list of (filename, tmp_path, size, sha256) of the kept
+        variants, written to temporary files.
+        """
+        filename = os.path.basename(path)
+        variants = []
+        for name in self.formats:
+            variant = await storage.run(_compress_file, path, name, tmp_dir)
+            if variant is None:
+                logger.debug('%s variant of %s is not smaller', name,
+                             filename)
+                continue
+            variants.append((compressed_filename(filename, name), ) + variant)
+        return variants
@@ -0,0 +1,106 @@
+"""Differential firmware updates module."""
+
+import os
+import uuid
+import asyncio
+import hashlib
+import logging
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+from catalog import DELTA_SUFFIX, version_key
+
+logger = logging.getLogger("otaserver")
+
+
+DELTA_VERSIONS = 0
+DELTA_WORKERS = 2
+
+
+def delta_filename(filename, old_version):
+    """Return the name of the patch from old_version to a slot file."""
+    base, version, _ = filename.rsplit('.', 2)
+    return '{}.{}-{}{}'.format(base, old_version, version, DELTA_SUFFIX)
+
+
+def _diff_files(old_path, new_path, delta_path, tmp_dir):
+    # Runs in a worker process
+    _tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    bsdiff4.file_diff(old_path, new_path, _tmp_path)
+    os.chmod(_tmp_path, 0o644)
+    with open(_tmp_path, 'rb') as f:
+        content = f.read()
+    os.replace(_tmp_path, delta_path)
+    return len(content), hashlib.sha256(content).hexdigest()
+
+
+class DeltaGenerator():
+    """Generate binary patches of new slot images in a process pool.
+
+    Patches are computed with bsdiff4 against the same slot of the
+    `versions` previous versions of the application. Generation is disabled
+    if `versions` is 0 or bsdiff4 is not installed.
+    """
+
+    def __init__(self, versions=DELTA_VERSIONS, workers=DELTA_WORKERS):
+        self.versions = versions
+        self._executor = None
+        if versions > 0 and bsdiff4 is None:
+            logger.warning("bsdiff4 is not installed, delta updates are "
+                           "disabled")
+        elif versions > 0:
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+
+    @property
+    def enabled(self):
+        """True if patches are generated at publish time."""
+        return self._executor is not None
+
+    async def generate(self, catalog, publish_id, version, tmp_dir):
+        """Generate the patches to the slot images of a new version.
+
+        Return the list of (filename, size, sha256) of the created patches.
+        """
+        versions = catalog.versions(publish_id)
+        # Patches go from the versions preceding the new one, even if
+        # newer versions were published before it
+        previous = sorted((v for v in versions
+                           if version_key(v) < version_key(version)),
+                          key=version_key)[-self.versions:]
+        store_path = os.path.join(catalog.upload_path, publish_id)
+        loop = asyncio.get_event_loop()
+        jobs = []
+        for slot in ('slot0', 'slot1'):
+            new_file = versions.get(version, {}).get(slot)
+            if new_file is None:
+                continue
+            for old_version in previous:
+                old_file = versions[old_version].get(slot)
+                if old_file is None:
+                    continue
+                name = delta_filename(new_file, old_version)
+                logger.debug('Generating delta %s', name)
+                jobs.append((name, loop.run_in_executor(
+                    self._executor, _diff_files,
+                    os.path.join(store_path, old_file),
+                    os.path.join(store_path, new_file),
+                    os.path.join(store_path, name), tmp_dir)))
+        deltas = []
+        for name, job in jobs:
+            try:
+                size, sha256 = await job
+            except Exception as exc:
+                logger.warning('Failed to generate delta %s: %s', name, exc)
+                continue
+            deltas.append((name, size, sha256))
+        return deltas
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,129 @@
+"""Device slot state module."""
+
+import time
+import logging
+
+import aiocoap
+import aiocoap.resource as resource
+from aiocoap.numbers.codes import Code
+
+from coap import url_host, _remote_address, COAP_PORT
+
+logger = logging.getLogger("otaserver")
+
+
+SLOT_STATE_TTL = 3600
+
+
+def _device_address(url):
+    # Host and port of a device url, the port defaulting to the CoAP one
+    host = url_host(url)
+    if url.startswith('['):
+        rest = url[url.index(']') + 1:]
+    else:
+        # The normalized host may differ from the one of the url
+        rest = url.split('/')[0]
+        rest = rest[rest.index(':'):] if rest.count(':') == 1 else ''
+    port = COAP_PORT
+    if rest.startswith(':'):
+        port = int(rest[1:].split('/')[0])
+    return host, port
+
+
+class SlotStateCache():
+    """Last known inactive slot of the devices.
+
+    Notifying a device of the manifest matching its inactive slot requires
+    to query the slot first. The answer is kept for `ttl` seconds, indexed by
+    the device address and port, so next notifications only send the
+    trigger. The states of a device are dropped once it downloaded an update,
+    since it changes of slot when applying it. Devices are matched by their
+    normalized address, so the states of IPv4 devices are dropped too. A
+    `ttl` of 0 disables the cache.
+    """
+
+    def __init__(self, ttl=SLOT_STATE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.registered = 0
+        # Host -> port -> (slot, timestamp)
+        self._states = {}
+
+    def get(self, url):
+        """Return the inactive slot of a device, None if unknown."""
+        host, port = _device_address(url)
+        state = self._states.get(host, {}).get(port)
+        if state is None or time.time() - state[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return state[0]
+
+    def set(self, url, slot):
+        """Set the inactive slot of a device."""
+        if self.ttl > 0:
+            host, port = _device_address(url)
+            self._states.setdefault(host, {})[port] = (slot, time.time())
+
+    def invalidate(self, url):
+        """Drop the inactive slot of a device."""
+        host, port = _device_address(url)
+        ports = self._states.get(host, {})
+        ports.pop(port, None)
+        if not ports:
+            self._states.pop(host, None)
+
+    def transfer_done(self, remote, publish_id, filename):
+        """Drop the states of a host that downloaded a slot image."""
+        if 'suit' not in filename:
+            self._states.pop(remote, None)
+
+    def stats(self):
+        """Return the cache counters."""
+        expiry = time.time() - self.ttl
+        for host, ports in list(self._states.items()):
+            ports = {port: state for port, state in ports.items()
+                     if state[1] > expiry}
+            if ports:
+                self._states[host] = ports
+            else:
+                del self._states[host]
+        return {
+            'entries': sum(len(ports) for ports in self._states.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'registered': self.registered,
+        }
+
+
+class SlotStateResource(resource.Resource):
+    """CoAP resource where devices register their inactive slot.
+
+    Devices PUT or POST their inactive slot, `0` or `1`, from their CoAP
+    server port when it changes, so the server doesn't query it before
+    notifying them.
+    """
+
+    def __init__(self, slot_states):
+        super(SlotStateResource, self).__init__()
+        self._slot_states = slot_states
+
+    async def render_put(self, request):
+        """Register the inactive slot of the requesting device."""
+        remote = _remote_address(request)
+        try:
+            port = request.remote[1]
+        except TypeError:
+            port = request.remote.sockaddr[1]
+        payload = request.payload.decode().strip()
+        if payload not in ('0', '1'):
+            return aiocoap.Message(code=Code.BAD_REQUEST,
+                                   payload=b'Expected 0 or 1')
+        logger.debug('Device %s registered inactive slot %s', remote, payload)
+        self._slot_states.set('[{}]:{}'.format(remote, port), int(payload))
+        self._slot_states.registered += 1
+        return aiocoap.Message(code=Code.CHANGED)
+
+    async def render_post(self, request):
+        return await self.render_put(request)
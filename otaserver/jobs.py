@@ -0,0 +1,225 @@
+"""Persistent notification jobs module."""
+
+import json
+import time
+import uuid
+import asyncio
+import logging
+import sqlite3
+import threading
+
+from notify import NOTIFY_CONCURRENCY, NOTIFY_TIMEOUT, _device_report
+
+logger = logging.getLogger("otaserver")
+
+
+JOBS_DB = '.jobs.sqlite'
+JOB_WORKERS = 4
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 5
+JOBS_LISTED = 100
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    publish_id TEXT NOT NULL,
+    created REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS devices (
+    job_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    report TEXT,
+    PRIMARY KEY (job_id, url)
+);
+'''
+
+
+class JobQueue():
+    """Durable queue of update notification jobs.
+
+    A job notifies an update to a list of devices. Jobs and the state of each
+    of their devices are stored in a SQLite database, so the notifications
+    are resumed where they stopped when the server restarts. Jobs are run by
+    `workers` background tasks, devices are notified as with
+    `notify_devices` and failed notifications are retried up to
+    `max_attempts` times, waiting `retry_delay` seconds before the first
+    retry and twice as long before each next one.
+
+    `notifier` is called with the publish identifier of a job and returns
+    the coroutine function notifying a device url. Database accesses are run
+    by the storage workers.
+    """
+
+    def __init__(self, path, notifier, storage, workers=JOB_WORKERS,
+                 concurrency=NOTIFY_CONCURRENCY, timeout=NOTIFY_TIMEOUT,
+                 max_attempts=JOB_MAX_ATTEMPTS, retry_delay=JOB_RETRY_DELAY):
+        self.notifier = notifier
+        self.storage = storage
+        self.workers = workers
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._queue = asyncio.Queue()
+        self._tasks = []
+
+    def _execute(self, query, args=(), many=False):
+        with self._lock, self._db:
+            if many:
+                cursor = self._db.executemany(query, args)
+            else:
+                cursor = self._db.execute(query, args)
+            return cursor.fetchall()
+
+    async def _query(self, query, args=(), many=False):
+        return await self.storage.run(self._execute, query, args, many)
+
+    async def start(self):
+        """Start the workers and resume the unfinished jobs."""
+        rows = await self._query(
+            'SELECT id FROM jobs WHERE finished IS NULL ORDER BY created')
+        if rows:
+            logger.info('Resuming %d notification jobs', len(rows))
+        for job_id, in rows:
+            self._queue.put_nowait(job_id)
+        self._tasks = [asyncio.ensure_future(self._work())
+                       for _ in range(self.workers)]
+
+    async def submit(self, publish_id, urls):
+        """Queue the notification of an update, return the job id."""
+        job_id = uuid.uuid4().hex
+        await self._query('INSERT INTO jobs (id, publish_id, created) '
+                          'VALUES (?, ?, ?)', (job_id, publish_id, time.time()))
+        await self._query('INSERT OR IGNORE INTO devices (job_id, url, state) '
+                          'VALUES (?, ?, ?)',
+                          [(job_id, url, 'pending') for url in urls],
+                          many=True)
+        logger.debug('Queued job %s notifying %d devices of %s',
+                     job_id, len(urls), publish_id)
+        self._queue.put_nowait(job_id)
+        return job_id
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as exc:
+                # The job is left unfinished and resumed at restart
+                logger.error('Notification job %s failed: %s', job_id, exc)
+
+    async def _run(self, job_id):
+        publish_id, = (await self._query(
+            'SELECT publish_id FROM jobs WHERE id = ?', (job_id,)))[0]
+        try:
+            notify_device = self.notifier(publish_id)
+        except Exception as exc:
+            logger.debug('Cannot notify devices of %s: %s', publish_id, exc)
+            await self._query(
+                'UPDATE devices SET state = ?, report = ? '
+                'WHERE job_id = ? AND state = ?',
+                ('failed', json.dumps({'status': 'error', 'error': str(exc)}),
+                 job_id, 'pending'))
+            notify_device = None
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while notify_device is not None:
+            now = time.time()
+            due = await self._query(
+                'SELECT url, attempts FROM devices WHERE job_id = ? AND '
+                'state = ? AND next_attempt <= ? ORDER BY rowid',
+                (job_id, 'pending', now))
+            if due:
+                await asyncio.gather(*[
+                    self._notify(job_id, notify_device, semaphore, url,
+                                 attempts) for url, attempts in due])
+                continue
+            next_attempt, = (await self._query(
+                'SELECT MIN(next_attempt) FROM devices '
+                'WHERE job_id = ? AND state = ?', (job_id, 'pending')))[0]
+            if next_attempt is None:
+                break
+            await asyncio.sleep(max(0, next_attempt - now))
+
+        await self._query('UPDATE jobs SET finished = ? WHERE id = ?',
+                          (time.time(), job_id))
+        logger.debug('Notification job %s finished', job_id)
+
+    async def _notify(self, job_id, notify_device, semaphore, url, attempts):
+        async with semaphore:
+            try:
+                code, payload = await asyncio.wait_for(notify_device(url),
+                                                       self.timeout)
+            except asyncio.TimeoutError:
+                report = {'url': url, 'status': 'timeout'}
+            except Exception as exc:
+                report = {'url': url, 'status': 'error', 'error': str(exc)}
+            else:
+                report = _device_report(url, code, payload)
+        attempts += 1
+        report['attempts'] = attempts
+        next_attempt = 0
+        if report['status'] == 'notified':
+            state = 'notified'
+        elif attempts >= self.max_attempts:
+            state = 'failed'
+        else:
+            state = 'pending'
+            next_attempt = time.time() + \
+                self.retry_delay * 2 ** (attempts - 1)
+            logger.debug('Notification of %s failed, retrying in %ds', url,
+                         next_attempt - time.time())
+        await self._query(
+            'UPDATE devices SET state = ?, attempts = ?, next_attempt = ?, '
+            'report = ? WHERE job_id = ? AND url = ?',
+            (state, attempts, next_attempt, json.dumps(report), job_id, url))
+
+    async def progress(self, job_id, with_devices=True):
+        """Return the progress of a job, None if it doesn't exist."""
+        rows = await self._query(
+            'SELECT publish_id, created, finished FROM jobs WHERE id = ?',
+            (job_id,))
+        if not rows:
+            return None
+        publish_id, created, finished = rows[0]
+        devices = await self._query(
+            'SELECT url, state, attempts, report FROM devices '
+            'WHERE job_id = ? ORDER BY rowid', (job_id,))
+        states = {}
+        for _, state, _, _ in devices:
+            states[state] = states.get(state, 0) + 1
+        progress = {
+            'id': job_id,
+            'publish_id': publish_id,
+            'created': created,
+            'finished': finished,
+            'states': states,
+        }
+        if with_devices:
+            progress['devices'] = [
+                {'url': url, 'state': state, 'attempts': attempts,
+                 'report': json.loads(report) if report else None}
+                for url, state, attempts, report in devices]
+        return progress
+
+    async def jobs(self):
+        """Return the progress of the most recent jobs."""
+        rows = await self._query(
+            'SELECT id FROM jobs ORDER BY created DESC LIMIT ?',
+            (JOBS_LISTED,))
+        return [await self.progress(job_id, with_devices=False)
+                for job_id, in rows]
+
+    def shutdown(self):
+        """Stop the workers, unfinished jobs are resumed at restart."""
+        for task in self._tasks:
+            task.cancel()
+        with self._lock:
+            self._db.close()
@@ -1,14 +1,30 @@
 """Broker application module."""
 
 import sys
+import signal
+import asyncio
 import os.path
 import tornado
 import logging
 
 from tornado.options import define, options
 
-from server import OTAServerApplication
-from coap import COAP_PORT, COAP_HOST
+from server import OTAServerApplication, MAX_UPLOAD_SIZE
+from cache import CACHE_MAX_SIZE
+from coap import COAP_PORT, COAP_HOST, COAP_CLIENT_POOL_SIZE
+from storage import STORAGE_WORKERS
+from workers import COAP_WORKERS
+from delta import DELTA_VERSIONS, DELTA_WORKERS
+from compress import COMPRESS_FORMATS
+from notify import NOTIFY_CONCURRENCY, NOTIFY_TIMEOUT, MULTICAST_WINDOW
+from jobs import JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY
+from devices import SLOT_STATE_TTL
+from blocks import BLOCK_SZX, BLOCK_MAX_SZX
+from retention import (RETENTION_KEEP, RETENTION_MAX_AGE,
+                       RETENTION_MAX_BYTES, RETENTION_INTERVAL,
+                       RETENTION_BATCH)
+from campaign import (CAMPAIGN_RATE, CAMPAIGN_MAX_ACTIVE,
+                      CAMPAIGN_DOWNLOAD_TIMEOUT)
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(name)14s - '
@@ -28,9 +44,86 @@ def parse_command_line():
            help="Path where uploaded files are stored.")
     define("http_host", default="localhost", help="Web application HTTP host.")
     define("http_port", default=8080, help="Web application HTTP port.")
+    define("max_upload_size", default=MAX_UPLOAD_SIZE,
+           help="Maximum size in bytes of a published update.")
     define("with_coap_server", default=True, help="Use own CoAP server.")
+    define("catalog_snapshot", default=True,
+           help="Load the firmware catalog from a snapshot at startup and "
+                "reconcile it with the upload path in the background.")
+    define("notify_concurrency", default=NOTIFY_CONCURRENCY,
+           help="Maximum number of devices notified concurrently.")
+    define("notify_timeout", default=NOTIFY_TIMEOUT,
+           help="Timeout in seconds of the notification of a device.")
+    define("notify_max_attempts", default=JOB_MAX_ATTEMPTS,
+           help="Number of notification attempts of a device.")
+    define("notify_retry_delay", default=JOB_RETRY_DELAY,
+           help="Time in seconds before retrying a failed notification, "
+                "doubled after each attempt.")
+    define("job_workers", default=JOB_WORKERS,
+           help="Number of notification jobs run concurrently.")
+    define("slot_state_ttl", default=SLOT_STATE_TTL,
+           help="Time in seconds the inactive slot of a device is cached "
+                "(0 disables the cache).")
+    define("with_slot_registration", default=False,
+           help="Let devices register their inactive slot on the "
+                "suit/slot/inactive CoAP resource.")
+    define("multicast_window", default=MULTICAST_WINDOW,
+           help="Time in seconds given to devices notified in multicast "
+                "to start fetching an update before they are notified in "
+                "unicast.")
     define("coap_host", default=COAP_HOST, help="CoAP server host.")
     define("coap_port", default=COAP_PORT, help="CoAP server port.")
+    define("coap_client_pool_size", default=COAP_CLIENT_POOL_SIZE,
+           help="Number of CoAP client contexts used for notifications.")
+    define("coap_cache_size", default=CACHE_MAX_SIZE,
+           help="Maximum size in bytes of the firmware content cache.")
+    define("coap_workers", default=COAP_WORKERS,
+           help="Number of processes serving the CoAP requests on the same "
+                "port (0 serves them in the main process).")
+    define("block_szx", default=BLOCK_SZX,
+           help="Default block size exponent of the CoAP transfers, blocks "
+                "are 2 ** (szx + 4) bytes.")
+    define("block_max_szx", default=BLOCK_MAX_SZX,
+           help="Maximum block size exponent of the CoAP transfers.")
+    define("block_policy", default=None,
+           help="JSON file with the block size exponents per publish id and "
+                "per remote network.")
+    define("block_measure", default=False,
+           help="Record the duration of the CoAP transfers per block size "
+                "and cycle the default block size over the allowed ones.")
+    define("campaign_rate", default=CAMPAIGN_RATE,
+           help="Default number of devices notified per second by a "
+                "campaign.")
+    define("campaign_max_active", default=CAMPAIGN_MAX_ACTIVE,
+           help="Default maximum number of devices downloading an update "
+                "at the same time in a campaign.")
+    define("campaign_download_timeout", default=CAMPAIGN_DOWNLOAD_TIMEOUT,
+           help="Time in seconds given to a notified device to download "
+                "an update.")
+    define("storage_workers", default=STORAGE_WORKERS,
+           help="Number of threads running filesystem operations.")
+    define("delta_versions", default=DELTA_VERSIONS,
+           help="Number of previous versions patches of new slot images are "
+                "generated from (requires bsdiff4, 0 disables patches).")
+    define("delta_workers", default=DELTA_WORKERS,
+           help="Number of processes generating patches.")
+    define("compress_formats", default=COMPRESS_FORMATS,
+           help="Comma separated formats of the compressed variants of the "
+                "slot images generated at publish time: deflate, lz4 "
+                "(requires lz4). Empty disables variants.")
+    define("retention_keep", default=RETENTION_KEEP,
+           help="Number of versions kept per application (0 keeps them "
+                "all).")
+    define("retention_max_age", default=RETENTION_MAX_AGE,
+           help="Time in seconds after which a version is removed (0 keeps "
+                "them forever).")
+    define("retention_max_bytes", default=RETENTION_MAX_BYTES,
+           help="Maximum size in bytes of the archive, the oldest versions "
+                "being removed first (0 doesn't limit it).")
+    define("retention_interval", default=RETENTION_INTERVAL,
+           help="Time in seconds between two sweeps of the archive.")
+    define("retention_batch", default=RETENTION_BATCH,
+           help="Number of files removed at once by a sweep.")
     define("debug", default=False, help="Enable debug mode.")
     options.parse_command_line()
 
@@ -55,11 +148,30 @@ def run(arguments=[]):
 
     try:
         app = OTAServerApplication()
-        app.listen(options.http_port)
-        tornado.ioloop.IOLoop.instance().start()
     except KeyboardInterrupt:
+        logger.debug("Interrupted while starting the application")
+        return
+    app.listen(options.http_port)
+
+    loop = asyncio.get_event_loop()
+
+    async def _shutdown():
         logger.debug("Stopping application")
-        tornado.ioloop.IOLoop.instance().stop()
+        try:
+            await app.shutdown()
+        finally:
+            tornado.ioloop.IOLoop.current().stop()
+
+    def _stop():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+        asyncio.ensure_future(_shutdown())
+
+    # Installed once the CoAP workers are forked, they're stopped by the
+    # application
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, _stop)
+    tornado.ioloop.IOLoop.current().start()
 
 if __name__ == '__main__':
     run()
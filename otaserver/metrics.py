@@ -0,0 +1,230 @@
+"""Prometheus-style metrics module."""
+
+import time
+import bisect
+import logging
+
+logger = logging.getLogger("otaserver")
+
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+TRANSFER_IDLE_TIMEOUT = 300
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, _escape(value))
+        for name, value in zip(names, values)))
+
+
+class Metric():
+    """Base class of metrics, values are indexed by label values."""
+
+    type = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+
+    def render(self):
+        """Return the metric in the Prometheus text exposition format."""
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for labels, value in self.values.items():
+            lines.append('{}{} {}'.format(
+                self.name, _labels(self.labels, labels), value))
+        return lines
+
+    def _merge(self, labels, value):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def load(self, snapshots):
+        """Set the values to the merged values of several instances."""
+        self.values = {}
+        for values in snapshots:
+            for labels, value in values.items():
+                self._merge(labels, value)
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    type = 'counter'
+
+    def inc(self, labels=(), value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def _merge(self, labels, value):
+        # Gauges of the different instances hold timestamps
+        self.values[labels] = max(self.values.get(labels, value), value)
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        counts = self.values.get(labels)
+        if counts is None:
+            # One count per bucket plus +Inf, then the sum
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _merge(self, labels, value):
+        counts = self.values.get(labels)
+        if counts is None:
+            self.values[labels] = list(value)
+            return
+        for index, count in enumerate(value):
+            counts[index] += count
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        names = self.labels + ('le',)
+        for labels, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(names, labels + (bound,)), total))
+            lines.append('{}_sum{} {}'.format(
+                self.name, _labels(self.labels, labels), counts[-1]))
+            lines.append('{}_count{} {}'.format(
+                self.name, _labels(self.labels, labels), total))
+        return lines
+
+
+def render_stats(prefix, stats, counters=()):
+    """Render a dictionary of numbers as gauges, the keys listed in
+    `counters` being rendered as counters."""
+    lines = []
+    for key, value in stats.items():
+        if key in counters:
+            name = '{}_{}_total'.format(prefix, key)
+            kind = 'counter'
+        else:
+            name = '{}_{}'.format(prefix, key)
+            kind = 'gauge'
+        lines += ['# TYPE {} {}'.format(name, kind),
+                  '{} {}'.format(name, value)]
+    return lines
+
+
+class CoapMetrics():
+    """Instrumentation of the CoAP file transfers.
+
+    A transfer starts when a remote fetches the first block of a file and
+    finishes when it fetches the last one. Transfers idle for more than
+    TRANSFER_IDLE_TIMEOUT seconds are no longer considered active.
+    """
+
+    def __init__(self):
+        self.blocks = Counter('otaserver_coap_blocks_total',
+                              'Blocks served per remote.', ('remote',))
+        self.bytes = Counter('otaserver_coap_bytes_total',
+                             'Bytes served per remote.', ('remote',))
+        self.transfers = Counter('otaserver_coap_transfers_total',
+                                 'Completed file transfers per remote.',
+                                 ('remote',))
+        self.started = Gauge('otaserver_coap_transfer_start_timestamp_seconds',
+                             'Start time of the last transfer per remote.',
+                             ('remote',))
+        self.finished = Gauge(
+            'otaserver_coap_transfer_finish_timestamp_seconds',
+            'Finish time of the last transfer per remote.', ('remote',))
+        self.latency = Histogram('otaserver_coap_request_duration_seconds',
+                                 'Time spent rendering a block request.')
+        self.active = Gauge('otaserver_coap_active_transfers',
+                            'Number of file transfers in progress.')
+        self.observations = Gauge('otaserver_coap_observations',
+                                  'Number of observations of the latest '
+                                  'manifests.')
+        self._active = {}
+        self._observations = {}
+        self._metrics = (self.blocks, self.bytes, self.transfers,
+                         self.started, self.finished, self.latency,
+                         self.active, self.observations)
+
+    def record_block(self, remote, path, block_number, size, more, duration):
+        """Record a served block."""
+        labels = (remote,)
+        self.blocks.inc(labels)
+        self.bytes.inc(labels, size)
+        self.latency.observe(duration)
+        now = time.time()
+        if block_number == 0:
+            self.started.set(now, labels)
+        if more:
+            self._active[(remote, path)] = now
+        else:
+            self._active.pop((remote, path), None)
+            self.transfers.inc(labels)
+            self.finished.set(now, labels)
+
+    def set_observations(self, resource, count):
+        """Set the number of observations of a resource."""
+        if count:
+            self._observations[resource] = count
+        else:
+            self._observations.pop(resource, None)
+
+    def _expire(self):
+        expiry = time.time() - TRANSFER_IDLE_TIMEOUT
+        self._active = {transfer: last for transfer, last
+                        in self._active.items() if last > expiry}
+        self.active.set(len(self._active))
+        self.observations.set(sum(self._observations.values()))
+
+    def snapshot(self):
+        """Return the state of the metrics, to be loaded by another process."""
+        self._expire()
+        return {'values': {metric.name: metric.values
+                           for metric in self._metrics},
+                'active': self._active,
+                'observations': self._observations}
+
+    def load(self, snapshots):
+        """Set the metrics to the merged snapshots of several processes."""
+        for metric in self._metrics:
+            metric.load(snapshot['values'].get(metric.name, {})
+                        for snapshot in snapshots)
+        self._active = {}
+        self._observations = {}
+        for snapshot in snapshots:
+            self._active.update(snapshot['active'])
+            for resource, count in snapshot['observations'].items():
+                self._observations[resource] = \
+                    self._observations.get(resource, 0) + count
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        self._expire()
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return lines
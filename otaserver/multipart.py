@@ -0,0 +1,160 @@
+"""Streaming multipart/form-data parser module."""
+
+import os
+import hashlib
+import tempfile
+import logging
+
+from email.message import Message
+
+logger = logging.getLogger("otaserver")
+
+
+def parse_boundary(content_type):
+    """Return the multipart boundary of a Content-Type header, if any."""
+    if not content_type.startswith('multipart/form-data'):
+        return None
+    for field in content_type.split(';'):
+        key, _, value = field.strip().partition('=')
+        if key == 'boundary' and value:
+            if value.startswith('"') and value.endswith('"'):
+                value = value[1:-1]
+            return value.encode()
+    return None
+
+
+def _parse_disposition(headers):
+    message = Message()
+    for line in headers.decode('utf-8').split('\r\n'):
+        name, _, value = line.partition(':')
+        message[name.strip()] = value.strip()
+    name = message.get_param('name', header='content-disposition')
+    filename = message.get_param('filename', header='content-disposition')
+    return name, filename
+
+
+class MultipartParser():
+    """Incremental parser of multipart/form-data request bodies.
+
+    Form fields are kept in memory in `arguments` and file parts are written
+    to temporary files in `tmp_path` as the data is received, their paths,
+    sizes and SHA-256 digests being available in `files`.
+    """
+
+    def __init__(self, boundary, tmp_path):
+        self.tmp_path = tmp_path
+        self.arguments = {}
+        self.files = {}
+        self._delimiter = b'\r\n--' + boundary
+        # Prepend a line break so the first boundary looks like the others
+        self._buffer = b'\r\n'
+        self._state = 'preamble'
+        self._part = None
+        self._value = None
+        self._file = None
+        self._hash = None
+        self._size = 0
+
+    def feed(self, chunk):
+        """Parse a new chunk of the request body."""
+        self._buffer += chunk
+        while self._step():
+            pass
+
+    def _step(self):
+        if self._state == 'preamble':
+            index = self._buffer.find(self._delimiter)
+            if index < 0:
+                self._buffer = self._buffer[-len(self._delimiter):]
+                return False
+            self._buffer = self._buffer[index + len(self._delimiter):]
+            self._state = 'delimiter'
+            return True
+
+        if self._state == 'delimiter':
+            if len(self._buffer) < 2:
+                return False
+            if self._buffer.startswith(b'--'):
+                self._buffer = b''
+                self._state = 'epilogue'
+                return False
+            self._buffer = self._buffer[2:]
+            self._state = 'headers'
+            return True
+
+        if self._state == 'headers':
+            index = self._buffer.find(b'\r\n\r\n')
+            if index < 0:
+                return False
+            self._start_part(self._buffer[:index])
+            self._buffer = self._buffer[index + 4:]
+            self._state = 'body'
+            return True
+
+        if self._state == 'body':
+            index = self._buffer.find(self._delimiter)
+            if index < 0:
+                # Keep enough data to detect a delimiter split across chunks
+                keep = len(self._delimiter) - 1
+                if len(self._buffer) > keep:
+                    self._write(self._buffer[:-keep])
+                    self._buffer = self._buffer[-keep:]
+                return False
+            self._write(self._buffer[:index])
+            self._end_part()
+            self._buffer = self._buffer[index + len(self._delimiter):]
+            self._state = 'delimiter'
+            return True
+
+        # Ignore anything after the closing delimiter
+        self._buffer = b''
+        return False
+
+    def _start_part(self, headers):
+        name, filename = _parse_disposition(headers)
+        self._part = name
+        if filename is None:
+            self._value = b''
+            return
+        fd, path = tempfile.mkstemp(dir=self.tmp_path)
+        self._file = os.fdopen(fd, 'wb')
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self.files.setdefault(name, []).append(
+            {'filename': filename, 'path': path})
+
+    def _write(self, data):
+        if self._file is not None:
+            self._file.write(data)
+            self._hash.update(data)
+            self._size += len(data)
+        else:
+            self._value += data
+
+    def _end_part(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            part = self.files[self._part][-1]
+            part['size'] = self._size
+            part['sha256'] = self._hash.hexdigest()
+        else:
+            self.arguments.setdefault(self._part, []).append(self._value)
+            self._value = None
+
+    @property
+    def complete(self):
+        """True if the closing delimiter of the body was parsed."""
+        return self._state == 'epilogue'
+
+    def cleanup(self):
+        """Remove the temporary files that were not moved elsewhere."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for parts in self.files.values():
+            for part in parts:
+                try:
+                    os.remove(part['path'])
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,51 @@
+"""Update notification fan-out module."""
+
+import asyncio
+import logging
+
+from aiocoap.numbers.codes import Code
+
+logger = logging.getLogger("otaserver")
+
+
+NOTIFY_CONCURRENCY = 64
+NOTIFY_TIMEOUT = 60
+MULTICAST_WINDOW = 30
+
+
+def _device_report(url, code, payload):
+    if isinstance(code, Code) and code.is_successful():
+        status = 'notified'
+    else:
+        status = 'failed'
+    return {'url': url, 'status': status,
+            'code': str(code), 'payload': payload}
+
+
+async def notify_devices(urls, notify_device,
+                         concurrency=NOTIFY_CONCURRENCY,
+                         timeout=NOTIFY_TIMEOUT):
+    """Notify a list of devices concurrently.
+
+    `notify_device` is a coroutine function called with each device url and
+    returning the CoAP (code, payload) of the trigger request. At most
+    `concurrency` devices are notified at the same time and each device is
+    given `timeout` seconds. A report is returned for each device, in the
+    order of `urls`.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _notify(url):
+        async with semaphore:
+            try:
+                code, payload = await asyncio.wait_for(notify_device(url),
+                                                       timeout)
+            except asyncio.TimeoutError:
+                logger.debug('Notification of %s timed out', url)
+                return {'url': url, 'status': 'timeout'}
+            except Exception as exc:
+                logger.debug('Notification of %s failed: %s', url, exc)
+                return {'url': url, 'status': 'error', 'error': str(exc)}
+        return _device_report(url, code, payload)
+
+    return await asyncio.gather(*[_notify(url) for url in urls])
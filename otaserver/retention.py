@@ -0,0 +1,248 @@
+"""Firmware archive retention module."""
+
+import os
+import time
+import asyncio
+import logging
+
+from tornado.ioloop import PeriodicCallback
+
+from catalog import version_key
+
+logger = logging.getLogger("otaserver")
+
+
+RETENTION_KEEP = 0
+RETENTION_MAX_AGE = 0
+RETENTION_MAX_BYTES = 0
+RETENTION_INTERVAL = 3600
+RETENTION_BATCH = 100
+
+
+def _remove_batch(blobs, files):
+    # Runs in a storage worker
+    return [blobs.remove(path, sha256) for path, sha256 in files]
+
+
+def _mtimes(paths):
+    # Runs in a storage worker
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+class ArchiveRetention():
+    """Removal of the old versions of the archived applications.
+
+    Versions of an application beyond the `keep` most recent ones, versions
+    published more than `max_age` seconds ago and, while the archive is
+    larger than `max_bytes`, the oldest versions are removed. A policy set
+    to 0 doesn't apply and the most recent version of an application is
+    never removed. Files are removed in batches of `batch` files by the
+    storage workers, and dropped from the catalog first so they're no
+    longer served. Once started, the archive is swept every `interval`
+    seconds.
+    """
+
+    def __init__(self, catalog, storage, blobs, cache, keep=RETENTION_KEEP,
+                 max_age=RETENTION_MAX_AGE, max_bytes=RETENTION_MAX_BYTES,
+                 interval=RETENTION_INTERVAL, batch=RETENTION_BATCH):
+        self.catalog = catalog
+        self.storage = storage
+        self.blobs = blobs
+        self.cache = cache
+        self.keep = keep
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.batch = batch
+        self.sweeps = 0
+        self.removed_versions = 0
+        self.removed_files = 0
+        self.released_blobs = 0
+        self.last_sweep = None
+        self.last_sweep_duration = None
+        self._sweeping = None
+        self._callback = None
+
+    @property
+    def enabled(self):
+        """True if a policy applies."""
+        return bool(self.keep or self.max_age or self.max_bytes)
+
+    async def remove(self, publish_id, filenames):
+        """Remove files of an application, return the number removed."""
+        upload_path = self.catalog.upload_path
+        files = []
+        for filename in filenames:
+            if not self.catalog.contains(publish_id, filename):
+                continue
+            metadata = self.catalog.metadata(publish_id, filename)
+            files.append((os.path.join(upload_path, publish_id, filename),
+                          metadata and metadata['sha256']))
+            self.catalog.remove(publish_id, filename)
+        for start in range(0, len(files), self.batch):
+            batch = files[start:start + self.batch]
+            logger.debug('Removing %d files of %s', len(batch), publish_id)
+            released = await self.storage.run(_remove_batch, self.blobs,
+                                              batch)
+            for (path, sha256), blob_released in zip(batch, released):
+                self.cache.invalidate(path)
+                if blob_released:
+                    self.cache.invalidate(sha256)
+            self.released_blobs += sum(released)
+        self.removed_files += len(files)
+        await self.catalog.save_metadata(self.storage, publish_id)
+        return len(files)
+
+    async def _published(self, publish_id, files):
+        # Files published before their time was recorded use the file time
+        published = [(self.catalog.metadata(publish_id, filename) or {})
+                     .get('published') for filename in files]
+        unknown = [filename for filename, timestamp in zip(files, published)
+                   if timestamp is None]
+        if unknown:
+            published += await self.storage.run(
+                _mtimes, [os.path.join(self.catalog.upload_path, publish_id,
+                                       filename) for filename in unknown])
+        return max((timestamp for timestamp in published
+                    if timestamp is not None), default=0)
+
+    def _blobs(self):
+        # Size and number of files of each stored content, files without a
+        # digest being their own content
+        blobs = {}
+        for publish_id in self.catalog.publish_ids():
+            for filename in self.catalog.files(publish_id):
+                metadata = self.catalog.metadata(publish_id, filename) or {}
+                key = metadata.get('sha256') or (publish_id, filename)
+                blob = blobs.setdefault(key, [metadata.get('size', 0), 0])
+                blob[1] += 1
+        return blobs
+
+    async def plan(self, now=None):
+        """Return the versions to remove according to the policies.
+
+        The size of a version is the number of bytes its removal frees,
+        counting contents shared with other files, like the latest aliases
+        or identical images, only once they're no longer used.
+        """
+        if now is None:
+            now = time.time()
+        blobs = self._blobs()
+        total = sum(size for size, _ in blobs.values())
+        released = set()
+
+        def _release(entry):
+            # Patches belong to two versions, files are released once
+            freed = 0
+            for filename in entry['files']:
+                if (entry['publish_id'], filename) in released:
+                    continue
+                released.add((entry['publish_id'], filename))
+                metadata = self.catalog.metadata(entry['publish_id'],
+                                                 filename) or {}
+                blob = blobs.get(metadata.get('sha256') or
+                                 (entry['publish_id'], filename))
+                if blob is None:
+                    # Published while planning
+                    continue
+                blob[1] -= 1
+                if blob[1] == 0:
+                    freed += blob[0]
+            entry['size'] = freed
+            return freed
+
+        removed = []
+        candidates = []
+        for publish_id in self.catalog.publish_ids():
+            versions = sorted(self.catalog.versions(publish_id),
+                              key=version_key)
+            for index, version in enumerate(versions[:-1]):
+                files = self.catalog.version_files(publish_id, version)
+                entry = {
+                    'publish_id': publish_id,
+                    'version': version,
+                    'files': files,
+                    'published': await self._published(publish_id, files),
+                }
+                if self.keep and index < len(versions) - self.keep:
+                    entry['reason'] = 'keep'
+                elif self.max_age and entry['published'] < now - self.max_age:
+                    entry['reason'] = 'max_age'
+                else:
+                    candidates.append(entry)
+                    continue
+                removed.append(entry)
+                total -= _release(entry)
+        if self.max_bytes:
+            for entry in sorted(candidates, key=lambda e: e['published']):
+                if total <= self.max_bytes:
+                    break
+                entry['reason'] = 'max_bytes'
+                removed.append(entry)
+                total -= _release(entry)
+        return removed
+
+    async def sweep(self):
+        """Remove the versions selected by the policies, return them."""
+        if self._sweeping is None:
+            self._sweeping = asyncio.ensure_future(self._sweep())
+        try:
+            return await asyncio.shield(self._sweeping)
+        finally:
+            if self._sweeping is not None and self._sweeping.done():
+                self._sweeping = None
+
+    async def _sweep(self):
+        start = time.perf_counter()
+        removed = await self.plan()
+        for entry in removed:
+            logger.info('Removing version %s of %s (%s)', entry['version'],
+                        entry['publish_id'], entry['reason'])
+            await self.remove(entry['publish_id'], entry['files'])
+        self.sweeps += 1
+        self.removed_versions += len(removed)
+        self.last_sweep = time.time()
+        self.last_sweep_duration = time.perf_counter() - start
+        return removed
+
+    async def _periodic_sweep(self):
+        try:
+            await self.sweep()
+        except Exception as exc:
+            logger.error('Archive sweep failed: %s', exc)
+
+    def start(self):
+        """Sweep the archive periodically, if a policy applies."""
+        if not self.enabled or self.interval <= 0:
+            return
+        self._callback = PeriodicCallback(self._periodic_sweep,
+                                          self.interval * 1000)
+        self._callback.start()
+        logger.debug('Archive swept every %ds', self.interval)
+
+    def stop(self):
+        """Stop sweeping the archive."""
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    def stats(self):
+        """Return the policies and the sweep counters."""
+        return {
+            'keep': self.keep,
+            'max_age': self.max_age,
+            'max_bytes': self.max_bytes,
+            'interval': self.interval,
+            'sweeps': self.sweeps,
+            'removed_versions': self.removed_versions,
+            'removed_files': self.removed_files,
+            'released_blobs': self.released_blobs,
+            'last_sweep': self.last_sweep,
+            'last_sweep_duration': self.last_sweep_duration,
+        }
@@ -5,65 +5,57 @@ import os.path
 import logging
 import json
 import datetime
+import time
+import shutil
 import asyncio
-
-from collections import defaultdict
+import functools
 
 import tornado
 import tornado.platform.asyncio
 from tornado.options import options
 from tornado import web
 
-from aiocoap import GET
-
-from coap import CoapServer, coap_request, COAP_METHOD
+from aiocoap import GET, NON
+from aiocoap.numbers.codes import Code
+
+from cache import FirmwareCache
+from catalog import FirmwareCatalog
+from storage import Storage
+from blobs import BlobStore
+from delta import DeltaGenerator
+from compress import Compressor, compressed_filename
+from multipart import MultipartParser, parse_boundary
+from coap import CoapServer, CoapClient, coap_request, url_host, COAP_METHOD
+from workers import CoapWorkers
+from notify import notify_devices
+from jobs import JobQueue, JOBS_DB
+from campaign import Campaign, CampaignScheduler
+from devices import SlotStateCache, SlotStateResource
+from blocks import BlockPolicy
+from retention import ArchiveRetention
+from metrics import render_stats
 
 logger = logging.getLogger("otaserver")
 
+INCOMING_DIR = '.incoming'
+MAX_UPLOAD_SIZE = 1024 * 1024 * 1024
+
 
 def _path_from_publish_id(publish_id):
     _path = publish_id.replace('/', '_').replace('\\', '_')
+    # Hidden entries of the upload path are the server stores
+    if not _path or _path.startswith('.'):
+        raise web.HTTPError(400, reason="Invalid publish id '{}'"
+                            .format(publish_id))
     return _path
 
 
-def _get_versions_from_path(path):
-    files = os.listdir(path)
-    versions = defaultdict(dict)
-    for file in files:
-        version = file.split('.')[-2]
-        if version == 'latest':
-            continue
-        if version == 'riot':
-            version = file.split('.')[-3]
-        if 'riot.suit' in file:
-            versions[version]['manifest'] = file
-        if 'slot0' in file:
-            versions[version]['slot0'] = file
-        if 'slot1' in file:
-            versions[version]['slot1'] = file
-    return versions
-
-
-def _get_applications(path):
-    applications = []
-    for d in os.listdir(path):
-        board, name = d.split('_', 1)
-        applications.append(
-            { 'id': d,
-              'name': name,
-              'board': board,
-              'count':int((len(os.listdir(os.path.join(path, d))) - 1) / 3),
-              'versions': _get_versions_from_path(os.path.join(path, d))
-            })
-    return applications
-
-
 class OTAServerMainHandler(web.RequestHandler):
     """Web application handler for web page."""
 
     def get(self):
         logger.debug("Rendering SUIT updates web page")
-        applications = _get_applications(options.upload_path)
+        applications = self.application.catalog.applications()
         self.render("otaserver.html",
                     favicon=os.path.join("assets", "favicon.ico"),
                     title="SUIT Update Server",
@@ -80,17 +72,29 @@ class OTAServerRemoveHandler(tornado.web.RequestHandler):
         request = json.loads(self.request.body.decode())
         logger.debug("Removing version %s in application %s",
                      request['version'], request['publish_id'])
-        for publish_id in os.listdir(options.upload_path):
-            if publish_id == request['publish_id']:
-                for filename in os.listdir(
-                        os.path.join(options.upload_path, publish_id)):
-                    if str(request['version']) not in filename:
-                        continue
-                    logger.debug("Removing file %s", filename)
-                    file = os.path.join(
-                        options.upload_path, publish_id, filename)
-                    if os.path.exists(file):
-                        os.remove(file)
+        publish_id = request['publish_id']
+        files = self.application.catalog.version_files(
+            publish_id, str(request['version']))
+        if not files:
+            self.set_status(404, "Unknown version")
+            return
+        await self.application.retention.remove(publish_id, files)
+
+
+class OTAServerRetentionHandler(web.RequestHandler):
+    """Web application handler for the archive retention.
+
+    GET returns the policies, the sweep counters and the versions that the
+    next sweep would remove, POST sweeps the archive immediately.
+    """
+
+    async def get(self):
+        stats = self.application.retention.stats()
+        stats['pending'] = await self.application.retention.plan()
+        self.write(stats)
+
+    async def post(self):
+        self.write({'removed': await self.application.retention.sweep()})
 
 
 class OTAServerCoapUrlHandler(web.RequestHandler):
@@ -104,58 +108,232 @@ class OTAServerCoapUrlHandler(web.RequestHandler):
         self.write(_coap_url)
 
 
+class OTAServerCatalogHandler(web.RequestHandler):
+    """Web application handler for getting the firmware catalog."""
+
+    def get(self):
+        self.write({'applications': self.application.catalog.applications()})
+
+
+class OTAServerCacheHandler(web.RequestHandler):
+    """Web application handler for getting the firmware cache counters."""
+
+    async def get(self):
+        if options.with_coap_server:
+            await self.application.coap_server.collect()
+            self.write(self.application.coap_server.cache_stats())
+        else:
+            self.write(self.application.firmware_cache.stats())
+
+
+class OTAServerStorageHandler(web.RequestHandler):
+    """Web application handler for getting the storage queue counters."""
+
+    def get(self):
+        stats = self.application.storage.stats()
+        stats['blobs'] = self.application.blobs.stats()
+        self.write(stats)
+
+
+class OTAServerBlocksHandler(web.RequestHandler):
+    """Web application handler for getting the block size policy."""
+
+    async def get(self):
+        if options.with_coap_server:
+            await self.application.coap_server.collect()
+        self.write(self.application.block_policy.stats())
+
+
+class OTAServerMetricsHandler(web.RequestHandler):
+    """Web application handler exporting Prometheus-style metrics."""
+
+    async def get(self):
+        if options.with_coap_server:
+            await self.application.coap_server.collect()
+            lines = render_stats('otaserver_cache',
+                                 self.application.coap_server.cache_stats(),
+                                 counters=('hits', 'misses'))
+        else:
+            lines = render_stats('otaserver_cache',
+                                 self.application.firmware_cache.stats(),
+                                 counters=('hits', 'misses'))
+        lines += render_stats('otaserver_storage',
+                              self.application.storage.stats(),
+                              counters=('completed', ))
+        lines += render_stats('otaserver_blobs',
+                              self.application.blobs.stats(),
+                              counters=('stored', 'deduplicated',
+                                        'deduplicated_bytes', 'released'))
+        lines += render_stats('otaserver_slot_states',
+                              self.application.slot_states.stats(),
+                              counters=('hits', 'misses', 'registered'))
+        retention = self.application.retention.stats()
+        counters = ('sweeps', 'removed_versions', 'removed_files',
+                    'released_blobs')
+        lines += render_stats('otaserver_retention', {
+            key: retention[key] for key in counters}, counters=counters)
+        if options.with_coap_server:
+            lines += self.application.coap_server.metrics.render()
+            lines += self.application.block_policy.render()
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write('\n'.join(lines) + '\n')
+
+
+def _slot_manifest_urls(catalog, publish_path):
+    files = catalog.files(publish_path)
+    base_filename = files[0].split('-')[0]
+
+    slot0_manifest_url = os.path.join(
+        publish_path,
+        '{}-slot0.riot.suit.latest.bin'.format(base_filename))
+    slot1_manifest_url = os.path.join(
+        publish_path,
+        '{}-slot1.riot.suit.latest.bin'.format(base_filename))
+    return slot0_manifest_url, slot1_manifest_url
+
+
+async def _notify_slot_device(client, slot_states, slot0_manifest_url,
+                              slot1_manifest_url, url):
+    """Notify a device of the manifest matching its inactive slot.
+
+    The inactive slot of the device is only queried if it's not known from
+    the slot states.
+    """
+    logger.debug('Notifying an update to %s', url)
+    inactive = slot_states.get(url)
+    if inactive is None:
+        inactive_url = '{}/suit/slot/inactive'.format(url)
+        _, payload = await coap_request(inactive_url,
+                                        method=GET,
+                                        client=client)
+        inactive = int(payload)
+        slot_states.set(url, inactive)
+    if inactive == 1:
+        manifest_url = slot1_manifest_url
+    else:
+        manifest_url = slot0_manifest_url
+    payload = '{}://{}:{}/{}'.format(COAP_METHOD, options.coap_host,
+                                     options.coap_port, manifest_url)
+    logger.debug('Manifest url is %s', payload)
+    notify_url = '{}/suit/trigger'.format(url)
+    logger.debug('Send update notification at %s', url)
+    code, payload = await coap_request(notify_url, payload=payload.encode(),
+                                       client=client)
+    if not isinstance(code, Code) or not code.is_successful():
+        # The device may have changed of slot, query it next time
+        slot_states.invalidate(url)
+    return code, payload
+
+
 class OTAServerNotifyHandler(tornado.web.RequestHandler):
-    """Handler for notifying an update to a list of devices."""
+    """Handler for notifying an update to a list of devices.
+
+    The notifications are queued as a job run in the background, whose
+    progress is available at `/jobs/<job id>`.
+    """
 
     async def post(self):
         """Handle notification of an available update."""
         publish_id = self.request.body_arguments['publish_id'][0].decode()
         publish_path = _path_from_publish_id(publish_id)
 
-        _store_path = os.path.join(self.application.upload_path, publish_id)
-        base_filename = os.listdir(_store_path)[0].split('-')[0]
-
-        slot0_manifest_url = os.path.join(
-            publish_path,
-            '{}-slot0.riot.suit.latest.bin'.format(base_filename))
-        slot1_manifest_url = os.path.join(
-            publish_path,
-            '{}-slot1.riot.suit.latest.bin'.format(base_filename))
-
         devices_urls = self.request.body_arguments['urls'][0].decode()
         logger.debug('Notifying devices %s of an update of %s',
                      devices_urls, publish_id)
 
-        for url in devices_urls.split(','):
-            logger.debug('Notifying an update to %s', url)
-            inactive_url = '{}/suit/slot/inactive'.format(url)
-            _, payload = await coap_request(inactive_url,
-                                            method=GET)
-            if int(payload) == 1:
-                manifest_url = slot1_manifest_url
-            else:
-                manifest_url = slot0_manifest_url
-            payload = '{}://{}:{}/{}'.format(COAP_METHOD, options.coap_host,
-                                             options.coap_port, manifest_url)
-            logger.debug('Manifest url is %s', payload)
-            notify_url = '{}/suit/trigger'.format(url)
-            logger.debug('Send update notification at %s', url)
-            await coap_request(notify_url, payload=payload.encode())
+        job_id = await self.application.jobs.submit(publish_path,
+                                                    devices_urls.split(','))
+        self.write({'publish_id': publish_id, 'job': job_id})
+
+
+class OTAServerJobsHandler(tornado.web.RequestHandler):
+    """Handler for following the notification jobs."""
+
+    async def get(self, job_id=None):
+        """Return the progress of one or all recent jobs."""
+        if job_id is None:
+            self.write({'jobs': await self.application.jobs.jobs()})
+            return
+        progress = await self.application.jobs.progress(job_id)
+        if progress is None:
+            raise web.HTTPError(404)
+        self.write(progress)
+
+
+class OTAServerCampaignHandler(tornado.web.RequestHandler):
+    """Handler for scheduling and following notification campaigns."""
+
+    def get(self, campaign_id=None):
+        """Return the progress of one or all campaigns."""
+        campaigns = self.application.campaigns.campaigns
+        if campaign_id is None:
+            self.write({'campaigns': [campaign.progress(with_devices=False)
+                                      for campaign in campaigns.values()]})
+            return
+        if campaign_id not in campaigns:
+            raise web.HTTPError(404)
+        self.write(campaigns[campaign_id].progress())
+
+    def post(self, campaign_id=None):
+        """Schedule the notification of an update to a list of devices."""
+        publish_id = self.request.body_arguments['publish_id'][0].decode()
+        publish_path = _path_from_publish_id(publish_id)
+        devices_urls = self.request.body_arguments['urls'][0].decode()
+        try:
+            rate = float(self.get_body_argument('rate', options.campaign_rate))
+            max_active = int(self.get_body_argument(
+                'max_active', options.campaign_max_active))
+        except ValueError:
+            rate = max_active = 0
+        msg = None
+        if not rate > 0:
+            msg = "Invalid rate, a positive number is expected"
+        elif max_active < 1:
+            msg = "Invalid max_active, a positive integer is expected"
+        if msg is not None:
+            self.set_status(400, msg)
+            self.finish(msg)
+            return
+        if not self.application.catalog.files(publish_path):
+            msg = "Unknown publish id '{}'".format(publish_id)
+            self.set_status(404, msg)
+            self.finish(msg)
+            return
+
+        notify_device = self.application.slot_notifier(publish_path)
+        campaign = Campaign(publish_path, devices_urls.split(','),
+                            notify_device, rate=rate, max_active=max_active,
+                            notify_timeout=options.notify_timeout,
+                            download_timeout=options.campaign_download_timeout,
+                            track_downloads=options.with_coap_server)
+        self.application.campaigns.submit(campaign)
+        logger.debug('Campaign %s scheduled for %s', campaign.id, publish_id)
+        self.write({'id': campaign.id})
 
 
 class OTAServerNotifyv4Handler(tornado.web.RequestHandler):
     """Handler for notifying an update to a list of devices."""
 
+    async def _notify_device(self, url):
+        logger.debug('Notifying an update to %s', url)
+        payload = '{}://{}:{}/{}'.format(COAP_METHOD, options.coap_host,
+                                         options.coap_port, self.manifest_url)
+        logger.debug('Manifest url is %s', payload)
+        notify_url = '{}/suit/trigger'.format(url)
+        logger.debug('Send update notification at %s', url)
+        return await coap_request(notify_url, payload=payload.encode(),
+                                  client=self.application.coap_client)
+
     async def post(self):
         """Handle notification of an available update."""
         version = self.request.body_arguments['version'][0].decode()
         publish_id = self.request.body_arguments['publish_id'][0].decode()
         publish_path = _path_from_publish_id(publish_id)
 
-        _store_path = os.path.join(self.application.upload_path, publish_id)
-        base_filename = os.listdir(_store_path)[0].split('-')[0]
+        files = self.application.catalog.files(publish_path)
+        base_filename = files[0].split('-')[0]
 
-        manifest_url = os.path.join(
+        self.manifest_url = os.path.join(
             publish_path,
             '{}-riot.suitv4_signed.{}.bin'.format(base_filename, version))
 
@@ -163,66 +341,309 @@ class OTAServerNotifyv4Handler(tornado.web.RequestHandler):
         logger.debug('Notifying devices %s of an update of %s',
                      devices_urls, publish_id)
 
+        report = await notify_devices(devices_urls.split(','),
+                                      self._notify_device,
+                                      concurrency=options.notify_concurrency,
+                                      timeout=options.notify_timeout)
+        self.write({'publish_id': publish_id, 'devices': report})
+
+
+class OTAServerNotifyMulticastHandler(OTAServerNotifyv4Handler):
+    """Handler for notifying an update to a multicast group of devices.
+
+    The trigger is sent once, as a NON request, to the multicast group
+    configured for the application. Devices listed in the optional `urls`
+    argument that didn't start fetching a file of the application within the
+    confirmation window are then notified in unicast.
+    """
+
+    async def post(self):
+        """Handle multicast notification of an available update."""
+        version = self.get_body_argument('version', 'latest')
+        publish_id = self.request.body_arguments['publish_id'][0].decode()
+        publish_path = _path_from_publish_id(publish_id)
+        group = self.get_body_argument(
+            'group', self.application.catalog.multicast_group(publish_path))
+        if not group:
+            msg = "No multicast group configured for {}".format(publish_id)
+            self.set_status(400, msg)
+            self.finish(msg)
+            return
+
+        files = self.application.catalog.files(publish_path)
+        base_filename = files[0].split('-')[0]
+
+        self.manifest_url = os.path.join(
+            publish_path,
+            '{}-riot.suitv4_signed.{}.bin'.format(base_filename, version))
+        payload = '{}://{}:{}/{}'.format(COAP_METHOD, options.coap_host,
+                                         options.coap_port, self.manifest_url)
+
+        logger.debug('Notifying multicast group %s of an update of %s',
+                     group, publish_id)
+        start = time.time()
+        code, response = await coap_request(
+            '{}/suit/trigger'.format(group), payload=payload.encode(),
+            client=self.application.coap_client, mtype=NON,
+            timeout=options.notify_timeout)
+        result = {'publish_id': publish_id, 'group': group,
+                  'multicast': {'code': str(code), 'payload': response},
+                  'devices': []}
+
+        devices_urls = self.get_body_argument('urls', '')
+        if not devices_urls:
+            self.write(result)
+            return
+
+        # Confirmation sweep of the devices that didn't start fetching
+        window = float(self.get_body_argument('window',
+                                              options.multicast_window))
+        await asyncio.sleep(window)
+        missing = []
         for url in devices_urls.split(','):
-            logger.debug('Notifying an update to %s', url)
-            payload = '{}://{}:{}/{}'.format(COAP_METHOD, options.coap_host,
-                                             options.coap_port, manifest_url)
-            logger.debug('Manifest url is %s', payload)
-            notify_url = '{}/suit/trigger'.format(url)
-            logger.debug('Send update notification at %s', url)
-            await coap_request(notify_url, payload=payload.encode())
+            if options.with_coap_server and \
+                    self.application.coap_server.fetched_since(
+                        url_host(url), publish_path, start):
+                result['devices'].append({'url': url, 'status': 'fetching'})
+            else:
+                missing.append(url)
+        logger.debug('Notifying %d devices in unicast', len(missing))
+        result['devices'] += await notify_devices(
+            missing, self._notify_device,
+            concurrency=options.notify_concurrency,
+            timeout=options.notify_timeout)
+        self.write(result)
+
+
+def _latest_path(path):
+    # Hack to determine if the file is a manifest and alias it as latest
+    _path_split = path.split('.')
+    if not ('suit' == _path_split[-3] or 'suitv4_signed' == _path_split[-3]):
+        return None
+    _path_split[-2] = 'latest'
+    return '.'.join(_path_split)
+
+
+async def _store_deltas(application, store_path, version):
+    """Generate and register the patches to a new version."""
+    _tmp_path = os.path.join(application.upload_path, INCOMING_DIR)
+    deltas = await application.deltas.generate(
+        application.catalog, store_path, version, _tmp_path)
+    for name, size, sha256 in deltas:
+        application.firmware_cache.invalidate(
+            os.path.join(application.upload_path, store_path, name))
+        application.catalog.add(store_path, name)
+        application.catalog.set_metadata(store_path, name, size, sha256)
+    if deltas:
+        await application.catalog.save_metadata(application.storage,
+                                                store_path)
+
+
+async def _store_variants(application, store_path, name, tmp_dir):
+    """Generate and register the compressed variants of a slot image."""
+    catalog = application.catalog
+    storage = application.storage
+    _store_path = os.path.join(application.upload_path, store_path)
+    variants = await application.compressor.compress(
+        storage, os.path.join(_store_path, name), tmp_dir)
+    kept = set()
+    for variant, tmp_path, size, sha256 in variants:
+        _path = os.path.join(_store_path, variant)
+        previous = catalog.metadata(store_path, variant)
+        await storage.run(application.blobs.store, tmp_path, sha256, _path,
+                          tmp_dir, previous and previous['sha256'])
+        application.firmware_cache.invalidate(_path)
+        catalog.add(store_path, variant)
+        catalog.set_metadata(store_path, variant, size, sha256)
+        kept.add(variant)
+    # Variants of a replaced file may no longer be worth keeping
+    for fmt in application.compressor.formats:
+        variant = compressed_filename(name, fmt)
+        if variant in kept or not catalog.contains(store_path, variant):
+            continue
+        _path = os.path.join(_store_path, variant)
+        previous = catalog.metadata(store_path, variant)
+        await storage.run(application.blobs.remove, _path,
+                          previous and previous['sha256'])
+        application.firmware_cache.invalidate(_path)
+        catalog.remove(store_path, variant)
 
 
+@web.stream_request_body
 class OTAServerPublishHandler(tornado.web.RequestHandler):
-    """Handler for storing published firmwares."""
-
-    def _store(self, store_url, data):
+    """Handler for storing published firmwares.
+
+    The request body is parsed as it is received and uploaded files are
+    written directly to temporary files on disk by the storage workers.
+    """
+
+    async def prepare(self):
+        self.request.connection.set_max_body_size(options.max_upload_size)
+        self.parser = None
+        self._feed = None
+        boundary = parse_boundary(
+            self.request.headers.get('Content-Type', ''))
+        if boundary is None:
+            return
+        _tmp_path = os.path.join(self.application.upload_path, INCOMING_DIR)
+        await self.application.storage.makedirs(_tmp_path)
+        self.parser = MultipartParser(boundary, _tmp_path)
+
+    def data_received(self, chunk):
+        if self.parser is not None:
+            self._feed = asyncio.ensure_future(
+                self.application.storage.run(self.parser.feed, chunk))
+            return self._feed
+
+    async def _cleanup(self, parser):
+        if self._feed is not None:
+            await asyncio.wait([self._feed])
+        await self.application.storage.run(parser.cleanup)
+
+    def on_finish(self):
+        parser, self.parser = self.parser, None
+        if parser is not None:
+            asyncio.ensure_future(self._cleanup(parser))
+
+    def on_connection_close(self):
+        self.on_finish()
+
+    async def _store(self, store_url, files):
+        storage = self.application.storage
         _store_path = os.path.join(self.application.upload_path, store_url)
-        if not os.path.exists(_store_path):
-            os.makedirs(_store_path)
-
-        # Store each data in separate files
-        for name, content in data.items():
+        _tmp_path = os.path.join(self.application.upload_path, INCOMING_DIR)
+        await storage.makedirs(_store_path)
+
+        # Store the content of each uploaded file once and link it to its
+        # final location
+        catalog = self.application.catalog
+        blobs = self.application.blobs
+        for name, part in files.items():
             _path = os.path.join(_store_path, name)
             logger.debug('Storing file %s', _path)
-            with open(_path, 'wb') as f:
-                f.write(content)
-            # Hack to determine if the file is a manifest and copy as latest
-            _path_split = _path.split('.')
-            if 'suit' == _path_split[-3] or 'suitv4_signed' == _path_split[-3]:
-                _path_split[-2] = 'latest'
-            _path = '.'.join(_path_split)
-            with open(_path, 'wb') as f:
-                f.write(content)
-
-    async def post(self):
-        """Handle publication of an update."""
+            previous = catalog.metadata(store_url, name)
+            await storage.run(blobs.store, part['path'], part['sha256'],
+                              _path, _tmp_path,
+                              previous and previous['sha256'])
+            self.application.firmware_cache.invalidate(_path)
+            catalog.add(store_url, name)
+            catalog.set_metadata(store_url, name, part['size'], part['sha256'])
+            if self.application.compressor.applies(name):
+                await _store_variants(self.application, store_url, name,
+                                      _tmp_path)
+            _latest = _latest_path(_path)
+            if _latest is None:
+                continue
+            _latest_name = os.path.basename(_latest)
+            previous = catalog.metadata(store_url, _latest_name)
+            await storage.run(blobs.link, part['sha256'], _latest, _tmp_path,
+                              previous and previous['sha256'])
+            self.application.firmware_cache.invalidate(_latest)
+            catalog.add(store_url, _latest_name)
+            catalog.set_metadata(store_url, _latest_name,
+                                 part['size'], part['sha256'])
+        await catalog.save_metadata(storage, store_url)
+
+    def _check_request(self):
         # Verify the request contains the required files
-        files = self.request.files
         msg = None
-        if len(files) == 0:
+        if self.parser is None or len(self.parser.files) == 0:
             msg = "No file found in request"
+        elif not self.parser.complete:
+            msg = "Incomplete multipart request"
         if msg is not None:
             self.set_status(400, msg)
             self.finish(msg)
+            return False
+        return True
+
+    async def _publish(self, store_path, update_files):
+        # Store the data, the catalog makes them available over CoAP
+        await self._store(store_path, update_files)
+
+        # Generate the patches from previous versions in the background
+        if self.application.deltas.enabled:
+            versions = set(name.split('.')[-2] for name in update_files
+                           if 'suit' not in name)
+            for version in versions:
+                asyncio.ensure_future(
+                    _store_deltas(self.application, store_path, version))
+
+    async def post(self):
+        """Handle publication of an update."""
+        if not self._check_request():
             return
 
-        # Load the content of the files from the request
-        update_data = {}
+        # Get the temporary files of the upload
+        files = self.parser.files
+        update_files = {}
         for file in files:
             filename = os.path.basename(file)
-            update_data[filename] = files[file][0]['body']
+            update_files[filename] = files[file][0]
 
         # Get publish identifier
-        publish_id = self.request.body_arguments['publish_id'][0].decode()
+        publish_id = self.parser.arguments['publish_id'][0].decode()
         # Cleanup the path
         store_path = _path_from_publish_id(publish_id)
         logger.debug('Storing %s update', publish_id)
 
-        # Store the data and create the corresponding CoAP resources
-        self._store(store_path, update_data)
-        if options.with_coap_server:
-            self.application.coap_server.add_resources(store_path)
+        # Optional multicast group notified of the updates
+        multicast_group = self.parser.arguments.get('multicast_group')
+        if multicast_group:
+            self.application.catalog.set_multicast_group(
+                store_path, multicast_group[0].decode())
+
+        await self._publish(store_path, update_files)
+
+
+class OTAServerPublishBatchHandler(OTAServerPublishHandler):
+    """Handler for storing the updates of several applications at once.
+
+    Each file part of the request is named after the publish identifier of
+    its application and carries its file name. Applications are stored in
+    parallel. The optional `notify` field is a JSON object giving the list of
+    device urls notified of the update of each publish identifier, a
+    notification job being queued per publish identifier.
+    """
+
+    async def post(self):
+        """Handle publication of the updates of several applications."""
+        if not self._check_request():
+            return
+
+        try:
+            notify = json.loads(
+                self.parser.arguments.get('notify', [b'{}'])[0].decode())
+        except ValueError:
+            notify = None
+        if not isinstance(notify, dict):
+            msg = "Invalid notify field"
+            self.set_status(400, msg)
+            self.finish(msg)
+            return
+
+        applications = {}
+        store_paths = {}
+        for publish_id, parts in self.parser.files.items():
+            applications[publish_id] = {
+                os.path.basename(part['filename']): part for part in parts}
+            store_paths[publish_id] = _path_from_publish_id(publish_id)
+        for publish_id in notify:
+            store_paths[publish_id] = _path_from_publish_id(publish_id)
+        logger.debug('Storing updates of %s', ', '.join(applications))
+        await asyncio.gather(*[
+            self._publish(store_paths[publish_id], update_files)
+            for publish_id, update_files in applications.items()])
+
+        result = {publish_id: {'files': sorted(update_files)}
+                  for publish_id, update_files in applications.items()}
+        for publish_id, urls in notify.items():
+            if not isinstance(urls, list):
+                urls = urls.split(',')
+            job_id = await self.application.jobs.submit(
+                store_paths[publish_id], urls)
+            result.setdefault(publish_id, {'files': []})['job'] = job_id
+        self.write({'applications': result})
 
 
 class OTAServerApplication(web.Application):
@@ -235,21 +656,148 @@ class OTAServerApplication(web.Application):
         handlers = [
             (r"/", OTAServerMainHandler),
             (r"/publish", OTAServerPublishHandler),
+            (r"/publishbatch", OTAServerPublishBatchHandler),
             (r"/remove", OTAServerRemoveHandler),
             (r"/notify", OTAServerNotifyHandler),
+            (r"/jobs", OTAServerJobsHandler),
+            (r"/jobs/(.*)", OTAServerJobsHandler),
             (r"/notifyv4", OTAServerNotifyv4Handler),
+            (r"/notifymulticast", OTAServerNotifyMulticastHandler),
+            (r"/campaign", OTAServerCampaignHandler),
+            (r"/campaign/(.*)", OTAServerCampaignHandler),
             (r"/coap/url/.*", OTAServerCoapUrlHandler),
+            (r"/catalog", OTAServerCatalogHandler),
+            (r"/cache", OTAServerCacheHandler),
+            (r"/storage", OTAServerStorageHandler),
+            (r"/metrics", OTAServerMetricsHandler),
+            (r"/blocks", OTAServerBlocksHandler),
+            (r"/retention", OTAServerRetentionHandler),
         ]
 
         settings = dict(debug=True,
                         static_path=options.static_path,
                         template_path=options.static_path,)
 
+        start = time.perf_counter()
         self.upload_path = options.upload_path
-        if options.with_coap_server:
+        # Uploads interrupted by a stop leave their temporary files
+        shutil.rmtree(os.path.join(self.upload_path, INCOMING_DIR),
+                      ignore_errors=True)
+        self.catalog = FirmwareCatalog(self.upload_path,
+                                       snapshot=options.catalog_snapshot)
+        self.storage = Storage(options.storage_workers)
+        if options.catalog_snapshot and self.catalog.load_snapshot():
+            source = 'snapshot'
+        else:
+            source = 'upload path'
+            self.catalog.build()
+        stats = self.catalog.stats()
+        logger.info('Catalog loaded from %s in %.1fms: %d applications, '
+                    '%d files', source, (time.perf_counter() - start) * 1000,
+                    stats['applications'], stats['files'])
+        self.blobs = BlobStore(self.upload_path)
+        self.deltas = DeltaGenerator(options.delta_versions,
+                                     options.delta_workers)
+        self.compressor = Compressor(
+            [name.strip() for name in options.compress_formats.split(',')
+             if name.strip()])
+        self.firmware_cache = FirmwareCache(options.coap_cache_size,
+                                            storage=self.storage)
+        policy = dict(default=options.block_szx,
+                      maximum=options.block_max_szx,
+                      measure=options.block_measure)
+        if options.block_policy is not None:
+            self.block_policy = BlockPolicy.from_file(options.block_policy,
+                                                      **policy)
+        else:
+            self.block_policy = BlockPolicy(**policy)
+        self.campaigns = CampaignScheduler()
+        slot_state_ttl = options.slot_state_ttl
+        if not options.with_coap_server and slot_state_ttl > 0:
+            # Slots are only invalidated by the downloads of the devices
+            logger.info('Slot state cache disabled, downloads are served '
+                        'by another CoAP server')
+            slot_state_ttl = 0
+        self.slot_states = SlotStateCache(slot_state_ttl)
+        if options.with_coap_server and options.coap_workers > 0:
+            # Forked before any thread is started
+            self.coap_server = CoapWorkers(
+                options.coap_workers, self.upload_path, options.coap_port,
+                options.coap_cache_size, self.catalog, self.block_policy,
+                slot_states=(self.slot_states
+                             if options.with_slot_registration else None),
+                storage_workers=options.storage_workers)
+        elif options.with_coap_server:
             self.coap_server = CoapServer(self.upload_path,
-                                          port=options.coap_port)
+                                          port=options.coap_port,
+                                          cache=self.firmware_cache,
+                                          catalog=self.catalog,
+                                          block_policy=self.block_policy)
+        if options.with_coap_server:
+            self.coap_server.transfer_listeners.append(
+                self.campaigns.transfer_done)
+            self.coap_server.transfer_listeners.append(
+                self.slot_states.transfer_done)
+            if options.with_slot_registration and \
+                    options.coap_workers == 0:
+                self.coap_server.root_coap.add_resource(
+                    ('suit', 'slot', 'inactive', ),
+                    SlotStateResource(self.slot_states))
+
+        asyncio.ensure_future(self.storage.run(self.blobs.collect))
+        asyncio.ensure_future(self._complete_catalog(source))
+        self.retention = ArchiveRetention(
+            self.catalog, self.storage, self.blobs, self.firmware_cache,
+            keep=options.retention_keep, max_age=options.retention_max_age,
+            max_bytes=options.retention_max_bytes,
+            interval=options.retention_interval,
+            batch=options.retention_batch)
+        self.retention.start()
+        self.coap_client = CoapClient(options.coap_client_pool_size)
+        asyncio.ensure_future(self.coap_client.start())
+
+        self.jobs = JobQueue(os.path.join(self.upload_path, JOBS_DB),
+                             self.slot_notifier, self.storage,
+                             workers=options.job_workers,
+                             concurrency=options.notify_concurrency,
+                             timeout=options.notify_timeout,
+                             max_attempts=options.notify_max_attempts,
+                             retry_delay=options.notify_retry_delay)
+        asyncio.ensure_future(self.jobs.start())
 
         super().__init__(handlers, **settings)
-        logger.info('Application started, listening on port {}'
-                    .format(options.http_port))
+        logger.info('Application started in %.1fms, listening on port %d',
+                    (time.perf_counter() - start) * 1000, options.http_port)
+
+    async def _complete_catalog(self, source):
+        start = time.perf_counter()
+        if source == 'snapshot':
+            updated = await self.catalog.reconcile(self.storage)
+            logger.info('Catalog reconciled with the upload path in %.1fms: '
+                        '%d applications updated',
+                        (time.perf_counter() - start) * 1000, len(updated))
+        else:
+            self.catalog.save_snapshot(self.storage)
+        # Served files must have a digest so their ETag is stable
+        start = time.perf_counter()
+        described = await self.catalog.complete_metadata(self.storage)
+        if described:
+            logger.info('Metadata of %d files computed in %.1fms', described,
+                        (time.perf_counter() - start) * 1000)
+
+    def slot_notifier(self, publish_path):
+        """Return the coroutine function notifying a device of the latest
+        update of an application."""
+        return functools.partial(
+            _notify_slot_device, self.coap_client, self.slot_states,
+            *_slot_manifest_urls(self.catalog, publish_path))
+
+    async def shutdown(self):
+        """Release the resources owned by the application."""
+        self.retention.stop()
+        self.jobs.shutdown()
+        await self.coap_server.shutdown()
+        await self.coap_client.shutdown()
+        self.catalog.write_snapshot()
+        self.storage.shutdown()
+        self.deltas.shutdown()
@@ -0,0 +1,82 @@
+"""Asynchronous storage module."""
+
+import os
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("otaserver")
+
+
+STORAGE_WORKERS = 4
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+class Storage():
+    """Thread pool running the blocking filesystem operations.
+
+    Coroutines of this class run the operations in worker threads so they
+    don't stall the event loop shared by the HTTP and CoAP servers.
+    """
+
+    def __init__(self, workers=STORAGE_WORKERS):
+        self.workers = workers
+        self.pending = 0
+        self.max_pending = 0
+        self.completed = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='storage')
+
+    async def run(self, func, *args):
+        """Run func(*args) in a worker thread and return its result."""
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self._executor, func, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    async def listdir(self, path):
+        """Return the list of entries of a directory."""
+        return await self.run(os.listdir, path)
+
+    async def makedirs(self, path):
+        """Create a directory and its parents if they don't exist."""
+        await self.run(lambda: os.makedirs(path, exist_ok=True))
+
+    async def read(self, path):
+        """Return the content of a file."""
+        return await self.run(_read_file, path)
+
+    async def remove(self, path):
+        """Remove a file, return False if it doesn't exist."""
+        return await self.run(_remove_file, path)
+
+    def stats(self):
+        """Return the storage queue counters."""
+        return {
+            'workers': self.workers,
+            'pending': self.pending,
+            'queued': max(0, self.pending - self.workers),
+            'max_pending': self.max_pending,
+            'completed': self.completed,
+        }
+
+    def shutdown(self):
+        """Wait for the pending operations and stop the worker threads."""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,256 @@
+"""Multi-process CoAP serving module."""
+
+import os
+import time
+import signal
+import asyncio
+import logging
+import multiprocessing
+
+from cache import FirmwareCache
+from storage import Storage
+from metrics import CoapMetrics
+from coap import CoapServer, CoapTransfers
+from devices import SlotStateResource
+
+logger = logging.getLogger("otaserver")
+
+
+COAP_WORKERS = 0
+FETCH_EVENT_INTERVAL = 1
+COLLECT_TIMEOUT = 2
+
+
+class _WorkerSlotStates():
+    """Forward the slots registered on a worker to the main process."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.registered = 0
+
+    def set(self, url, slot):
+        self._conn.send(('slot', url, slot))
+
+
+class _WorkerCoapServer(CoapServer):
+    """CoAP server of a worker process, forwarding the fetches to the main
+    process."""
+
+    def __init__(self, conn, *args, **kwargs):
+        super(_WorkerCoapServer, self).__init__(*args, **kwargs)
+        self._conn = conn
+        self._sent = {}
+        self.transfer_listeners.append(self._send_transfer)
+
+    def record_fetch(self, remote, publish_id):
+        super(_WorkerCoapServer, self).record_fetch(remote, publish_id)
+        # Fetches only need to be known to the second
+        now = time.time()
+        sent = self._sent.get(remote)
+        if sent is None or sent[0] != publish_id or \
+                now - sent[1] >= FETCH_EVENT_INTERVAL:
+            self._sent[remote] = (publish_id, now)
+            self._conn.send(('fetch', remote, publish_id, now))
+
+    def _send_transfer(self, remote, publish_id, filename):
+        self._conn.send(('transfer', remote, publish_id, filename))
+
+    async def sync(self, publish_id):
+        """Reload an application of the catalog changed by the main
+        process."""
+        _store_path = os.path.join(self.upload_path, publish_id)
+        files = set(self.catalog.files(publish_id))
+        await self.catalog.reload(self.cache.storage, publish_id)
+        files |= set(self.catalog.files(publish_id))
+        # Entries indexed by digest hold content verified against it when
+        # loaded, only the entries of files without a digest are outdated.
+        # Until the sync, files replaced on disk either hit the entry of
+        # their previous digest or are loaded and indexed by path.
+        for filename in files:
+            self.cache.invalidate(os.path.join(_store_path, filename))
+        self.root_coap.updated(publish_id)
+
+
+async def _serve(conn, config):
+    storage = Storage(config['storage_workers'])
+    server = _WorkerCoapServer(
+        conn, config['upload_path'], port=config['port'],
+        cache=FirmwareCache(config['cache_size'], storage=storage),
+        catalog=config['catalog'], block_policy=config['block_policy'])
+    if config['slot_registration']:
+        server.root_coap.add_resource(
+            ('suit', 'slot', 'inactive', ),
+            SlotStateResource(_WorkerSlotStates(conn)))
+    await server.context
+
+    loop = asyncio.get_event_loop()
+    messages = asyncio.Queue()
+
+    def _receive():
+        try:
+            messages.put_nowait(conn.recv())
+        except (EOFError, OSError):
+            # The main process is gone
+            loop.remove_reader(conn.fileno())
+            messages.put_nowait(('stop', ))
+
+    loop.add_reader(conn.fileno(), _receive)
+    while True:
+        message = await messages.get()
+        if message[0] == 'sync':
+            await server.sync(message[1])
+        elif message[0] == 'snapshot':
+            conn.send(('snapshot', server.metrics.snapshot(),
+                       server.block_policy.snapshot(), server.cache.stats()))
+        else:
+            break
+    await server.shutdown()
+    storage.shutdown()
+
+
+def _run_worker(conn, conns, config):
+    # Interrupts are handled by the main process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Only keep this worker end, so closed ends are detected on both sides
+    for other_conn in conns:
+        if other_conn is not conn:
+            other_conn.close()
+    os.environ['AIOCOAP_REUSE_PORT'] = '1'
+    try:
+        asyncio.run(_serve(conn, config))
+    except (EOFError, BrokenPipeError):
+        # The main process is gone
+        pass
+
+
+class CoapWorkers(CoapTransfers):
+    """CoAP server running in several processes sharing the CoAP port.
+
+    Each of the `workers` processes runs its own CoAP server, with its own
+    copy of the catalog and its own firmware content cache, bound to the
+    CoAP port with SO_REUSEPORT so the kernel spreads the incoming requests
+    over the processes. Workers are forked and must be started before any
+    thread of the main process. Workers send their fetches, throttled to one
+    every FETCH_EVENT_INTERVAL seconds per remote, the completed transfers
+    and the registered slots to the main process, which tells them to
+    reload the applications changed in the catalog. Metrics and block
+    measures of the workers are merged by `collect`.
+    """
+
+    def __init__(self, workers, upload_path, port, cache_size, catalog,
+                 block_policy, slot_states=None, storage_workers=1):
+        super(CoapWorkers, self).__init__()
+        self.upload_path = upload_path
+        self.catalog = catalog
+        self.block_policy = block_policy
+        self.slot_states = slot_states
+        self.metrics = CoapMetrics()
+        self._cache_stats = {}
+        self._snapshots = {}
+        config = dict(upload_path=upload_path, port=port,
+                      cache_size=cache_size, catalog=catalog,
+                      block_policy=block_policy,
+                      slot_registration=slot_states is not None,
+                      storage_workers=storage_workers)
+        context = multiprocessing.get_context('fork')
+        pipes = [context.Pipe() for _ in range(workers)]
+        conns = [conn for pipe in pipes for conn in pipe]
+        self._workers = []
+        for parent_conn, conn in pipes:
+            process = context.Process(target=_run_worker,
+                                      args=(conn, conns, config),
+                                      name='coap-worker', daemon=True)
+            process.start()
+            conn.close()
+            self._workers.append((process, parent_conn))
+        logger.info('Started %d CoAP workers on port %d', workers, port)
+
+        loop = asyncio.get_event_loop()
+        for worker in self._workers:
+            loop.add_reader(worker[1].fileno(), self._receive, worker)
+        catalog.listeners.append(self.sync)
+
+    def _receive(self, worker):
+        process, conn = worker
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            logger.error('CoAP worker %d exited with code %s', process.pid,
+                         process.exitcode)
+            asyncio.get_event_loop().remove_reader(conn.fileno())
+            conn.close()
+            self._workers.remove(worker)
+            self._snapshots.pop(process.pid, None)
+            return
+        if message[0] == 'fetch':
+            _, remote, publish_id, timestamp = message
+            self.fetches[remote] = (publish_id, timestamp)
+        elif message[0] == 'transfer':
+            self.transfer_done(*message[1:])
+        elif message[0] == 'slot' and self.slot_states is not None:
+            self.slot_states.set(*message[1:])
+            self.slot_states.registered += 1
+        elif message[0] == 'snapshot':
+            waiter = self._snapshots.pop(process.pid, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(message[1:])
+
+    def sync(self, publish_id):
+        """Tell the workers to reload an application of the catalog."""
+        for _, conn in self._workers:
+            try:
+                conn.send(('sync', publish_id))
+            except OSError:
+                # Exited workers are dropped by _receive
+                pass
+
+    async def collect(self):
+        """Merge the metrics and block measures of the workers."""
+        loop = asyncio.get_event_loop()
+        waiters = []
+        for process, conn in self._workers:
+            waiter = self._snapshots.get(process.pid)
+            if waiter is None:
+                try:
+                    conn.send(('snapshot', ))
+                except OSError:
+                    continue
+                waiter = self._snapshots[process.pid] = loop.create_future()
+            waiters.append(waiter)
+        if not waiters:
+            return
+        done, _ = await asyncio.wait(waiters, timeout=COLLECT_TIMEOUT)
+        snapshots = [waiter.result() for waiter in done]
+        if len(snapshots) < len(waiters):
+            logger.warning('%d CoAP workers did not send their metrics',
+                           len(waiters) - len(snapshots))
+        self.metrics.load([snapshot[0] for snapshot in snapshots])
+        self.block_policy.load([snapshot[1] for snapshot in snapshots])
+        self._cache_stats = {}
+        for _, _, stats in snapshots:
+            for key, value in stats.items():
+                self._cache_stats[key] = self._cache_stats.get(key, 0) + value
+
+    def cache_stats(self):
+        """Return the counters of the worker caches, as of the last
+        collect."""
+        stats = dict(self._cache_stats)
+        stats['workers'] = len(self._workers)
+        return stats
+
+    async def shutdown(self):
+        """Stop the worker processes."""
+        loop = asyncio.get_event_loop()
+        for process, conn in self._workers:
+            loop.remove_reader(conn.fileno())
+            try:
+                conn.send(('stop', ))
+            except OSError:
+                pass
+        for process, conn in self._workers:
+            process.join(COLLECT_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+        self._workers = []
+        logger.debug('CoAP workers stopped')
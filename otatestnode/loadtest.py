@@ -0,0 +1,274 @@
+"""Load test of the OTA server with simulated CoAP nodes."""
+
+
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+
+from urllib.parse import urlencode
+
+import aiocoap
+import aiocoap.resource as resource
+from aiocoap import Context, Message, GET, CHANGED, CONTENT
+from tornado.httpclient import AsyncHTTPClient
+
+
+LOGGER = logging.getLogger("otaloadtest")
+LOGGER.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)-15s %(levelname)-7s '
+                              '%(filename)10s:%(lineno)-3d %(message)s')
+console_handler = logging.StreamHandler(sys.stderr)
+console_handler.setFormatter(formatter)
+LOGGER.addHandler(console_handler)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="OTA server load test")
+    parser.add_argument('--ota-host-url', type=str,
+                        default="http://localhost:8080",
+                        help="OTA server host url.")
+    parser.add_argument('--publish-id', type=str, required=True,
+                        help="Published update the nodes are notified of.")
+    parser.add_argument('--nodes', type=int, default=100,
+                        help="Number of simulated nodes.")
+    parser.add_argument('--host', type=str, default="::1",
+                        help="Address the simulated nodes listen on.")
+    parser.add_argument('--base-port', type=int, default=5700,
+                        help="CoAP port of the first node, each node uses "
+                             "the next port.")
+    parser.add_argument('--distinct-hosts', action='store_true',
+                        help="Give each node its own 127.x.y.z address, so "
+                             "the server can tell the nodes apart.")
+    parser.add_argument('--mode', choices=('notify', 'campaign'),
+                        default='notify',
+                        help="Notify the nodes with /notify or with a "
+                             "campaign.")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="Campaign notification rate (devices/s).")
+    parser.add_argument('--max-active', type=int, default=None,
+                        help="Campaign maximum concurrent downloads.")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="Time in seconds given to the nodes to "
+                             "complete the update.")
+    parser.add_argument('--output', type=str, default=None,
+                        help="Write the JSON report to this file.")
+    return parser.parse_args()
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    percentiles = {'p{}'.format(p): values[min(len(values) - 1,
+                                               int(len(values) * p / 100))]
+                   for p in (50, 90, 99)}
+    percentiles['max'] = values[-1]
+    percentiles['mean'] = sum(values) / len(values)
+    return percentiles
+
+
+def _node_host(args, index):
+    if not args.distinct_hosts:
+        return args.host
+    # Linux routes the whole 127.0.0.0/8 network to the loopback interface
+    return '127.{}.{}.{}'.format(1 + index // (254 * 256),
+                                 index // 254 % 256, 1 + index % 254)
+
+
+class TriggerResource(resource.Resource):
+    """Simulated node firmware notify resource."""
+
+    def __init__(self, node):
+        super(TriggerResource, self).__init__()
+        self.node = node
+
+    async def render_post(self, request):
+        self.node.trigger(request.payload.decode())
+        return aiocoap.Message(code=CHANGED, payload=request.payload)
+
+
+class InactiveResource(resource.Resource):
+    """Simulated node firmware inactive slot resource."""
+
+    def __init__(self, node):
+        super(InactiveResource, self).__init__()
+        self.node = node
+
+    async def render_get(self, request):
+        return aiocoap.Message(code=CONTENT,
+                               payload='{}'.format(self.node.inactive).encode())
+
+
+class SimulatedNode():
+    """Node downloading the manifest and the slot image it is notified of.
+
+    The node uses its server context to fetch the files, so the server sees
+    each node as a distinct remote endpoint.
+    """
+
+    def __init__(self, index, host, port, images):
+        self.index = index
+        if ':' in host:
+            self.url = '[{}]:{}'.format(host, port)
+        else:
+            self.url = '{}:{}'.format(host, port)
+        self.host = host
+        self.port = port
+        self.inactive = index % 2
+        self.images = images
+        self.context = None
+        self.triggered = None
+        self.completed = None
+        self.bytes = 0
+        self.error = None
+        self.done = asyncio.Event()
+
+    async def start(self):
+        site = resource.Site()
+        site.add_resource(('suit', 'trigger', ), TriggerResource(self))
+        site.add_resource(('suit', 'slot', 'inactive', ),
+                          InactiveResource(self))
+        self.context = await Context.create_server_context(
+            site, bind=(self.host, self.port))
+
+    async def stop(self):
+        if self.context is not None:
+            await self.context.shutdown()
+
+    def trigger(self, manifest_url):
+        if self.triggered is not None:
+            return
+        self.triggered = time.time()
+        asyncio.ensure_future(self._update(manifest_url))
+
+    async def _get(self, url):
+        request = Message(code=GET)
+        request.set_request_uri(url)
+        response = await self.context.request(request).response
+        if not response.code.is_successful():
+            raise RuntimeError('{} {}'.format(response.code, url))
+        self.bytes += len(response.payload)
+        return response.payload
+
+    async def _update(self, manifest_url):
+        try:
+            await self._get(manifest_url)
+            slot = 'slot1' if 'slot1' in manifest_url else \
+                'slot{}'.format(self.inactive)
+            image = self.images.get(slot)
+            if image is not None:
+                base_url = manifest_url.rsplit('/', 1)[0]
+                await self._get('{}/{}'.format(base_url, image))
+            self.completed = time.time()
+        except Exception as exc:
+            self.error = str(exc) or type(exc).__name__
+            LOGGER.debug('Node %s failed: %s', self.url, self.error)
+        self.done.set()
+
+
+async def _latest_images(client, args):
+    response = await client.fetch('{}/catalog'.format(args.ota_host_url))
+    publish_path = args.publish_id.replace('/', '_').replace('\\', '_')
+    for application in json.loads(response.body)['applications']:
+        if application['id'] != publish_path:
+            continue
+        versions = application['versions']
+        latest = sorted(versions, key=lambda v: (not v.isdigit(),
+                                                 int(v) if v.isdigit() else 0,
+                                                 v))[-1]
+        return {slot: versions[latest][slot] for slot in ('slot0', 'slot1')
+                if slot in versions[latest]}
+    raise RuntimeError('{} not found on server'.format(args.publish_id))
+
+
+async def _notify(client, args, nodes):
+    body = dict(publish_id=args.publish_id,
+                urls=','.join(node.url for node in nodes))
+    if args.mode == 'campaign':
+        if args.rate is not None:
+            body['rate'] = args.rate
+        if args.max_active is not None:
+            body['max_active'] = args.max_active
+    response = await client.fetch(
+        '{}/{}'.format(args.ota_host_url, args.mode), method='POST',
+        body=urlencode(body), request_timeout=args.timeout)
+    return json.loads(response.body)
+
+
+async def run(args):
+    client = AsyncHTTPClient()
+    images = await _latest_images(client, args)
+    LOGGER.info('Starting %d nodes, images %s', args.nodes, images)
+    nodes = [SimulatedNode(index, _node_host(args, index),
+                           args.base_port + index, images)
+             for index in range(args.nodes)]
+    await asyncio.gather(*[node.start() for node in nodes])
+
+    start = time.time()
+    progress_url = None
+    try:
+        response = await _notify(client, args, nodes)
+    except Exception as exc:
+        LOGGER.error('Notification failed: %s', exc)
+    else:
+        if args.mode == 'notify':
+            LOGGER.info('Queued notification job %s', response['job'])
+            progress_url = '{}/jobs/{}'.format(args.ota_host_url,
+                                               response['job'])
+        else:
+            LOGGER.info('Started campaign %s', response['id'])
+            progress_url = '{}/campaign/{}'.format(args.ota_host_url,
+                                                   response['id'])
+    remaining = max(0, args.timeout - (time.time() - start))
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*[node.done.wait() for node in nodes]), remaining)
+    except asyncio.TimeoutError:
+        LOGGER.warning('Timeout waiting for the nodes to complete')
+    duration = time.time() - start
+    await asyncio.gather(*[node.stop() for node in nodes])
+
+    # Notification states of the devices, as seen by the server
+    notified = {}
+    if progress_url is not None:
+        response = await client.fetch(progress_url)
+        notified = json.loads(response.body)['states']
+
+    completed = [node for node in nodes if node.completed is not None]
+    errors = {}
+    for node in nodes:
+        if node.error is not None:
+            errors[node.error] = errors.get(node.error, 0) + 1
+    total_bytes = sum(node.bytes for node in nodes)
+    return {
+        'nodes': len(nodes),
+        'mode': args.mode,
+        'duration': duration,
+        'completed': len(completed),
+        'notify_statuses': notified,
+        'not_triggered': sum(1 for node in nodes if node.triggered is None),
+        'error_rate': sum(errors.values()) / len(nodes),
+        'errors': errors,
+        'bytes': total_bytes,
+        'throughput': {
+            'bytes_per_second': total_bytes / duration,
+            'updates_per_second': len(completed) / duration,
+        },
+        'notify_to_complete': _percentiles(
+            [node.completed - start for node in completed]),
+        'trigger_to_complete': _percentiles(
+            [node.completed - node.triggered for node in completed]),
+    }
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = asyncio.get_event_loop().run_until_complete(run(args))
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)